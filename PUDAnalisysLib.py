@@ -1,9 +1,17 @@
+import os
+import sys
+import mmap
 import sqlite3
 import json
+import hashlib
+import cProfile
+import numpy as np
 
-from collections import Counter
-from queue import Queue
+from array import array
+from collections import Counter, deque
+from contextlib import contextmanager
 from itertools import combinations as combs
+from time import perf_counter
 
 
 def conll2graph(record):
@@ -42,27 +50,373 @@ def conll2graph(record):
     return (nodes, graph)
 
 
+# Relation labels and POS tags are interned to small integers shared
+# by all trees, so that a parsed sentence is a handful of flat arrays.
+RELATIONS = []
+POS_TAGS = []
+_relation_ids = {}
+_pos_ids = {}
+
+
+def _intern(label, labels, ids):
+    label_id = ids.get(label)
+    if label_id is None:
+        label_id = ids[label] = len(labels)
+        labels.append(label)
+    return label_id
+
+
+class TreeNode:
+    """A view of a single token of a SentenceTree. Supports item access
+    with the keys of the node dictionaries produced by conll2graph."""
+    __slots__ = ('tree', 'index')
+
+    _fields = frozenset(('wordform', 'pos', 'relation', 'parent'))
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def wordform(self):
+        return self.tree.forms[self.index]
+
+    @property
+    def pos(self):
+        return POS_TAGS[self.tree.pos_ids[self.index]]
+
+    @property
+    def relation(self):
+        return RELATIONS[self.tree.relation_ids[self.index]]
+
+    @property
+    def parent(self):
+        return str(self.tree.heads[self.index])
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'TreeNode({self.index}, {self.wordform!r}, {self.pos}, {self.relation} <- {self.parent})'
+
+
+class SentenceTree:
+    """A compact dependency tree. Position 0 is the artificial root;
+    tokens occupy positions 1..n. Heads are stored as integers, relations
+    and POS tags as ids into RELATIONS and POS_TAGS.
+
+    The tree doubles as the node dictionary of conll2graph: it is
+    indexed by string keys ('1', '2', ...), iterates over them in order,
+    and returns TreeNode views. It is accepted as the graph argument
+    of get_path, get_node_depth and highest_or_none."""
+    __slots__ = ('heads', 'relation_ids', 'pos_ids', 'forms', '_depths', '_lca_index')
+
+    def __init__(self, heads, relation_ids, pos_ids, forms):
+        self.heads = heads
+        self.relation_ids = relation_ids
+        self.pos_ids = pos_ids
+        self.forms = forms
+        self._depths = None
+        self._lca_index = None
+
+    def __len__(self):
+        return len(self.heads) - 1
+
+    def __iter__(self):
+        return map(str, range(1, len(self.heads)))
+
+    def __contains__(self, key):
+        try:
+            return 0 < int(key) < len(self.heads)
+        except (TypeError, ValueError):
+            return False
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return TreeNode(self, int(key))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((str(i), TreeNode(self, i)) for i in range(1, len(self.heads)))
+
+    def node_index(self, key):
+        """Converts a node key to a position in the arrays."""
+        if key not in self and str(key) != '0':
+            raise IndexError(f"Target node unreachable: {key}")
+        return int(key)
+
+    def edge_label(self, i):
+        """The relation label of the edge between i and its head."""
+        return RELATIONS[self.relation_ids[i]]
+
+    @property
+    def depths(self):
+        """Number of edges between each position and the root as an
+        array('i'), computed in a single pass over the heads on first
+        use and cached. Trees are small, so plain Python lists beat
+        NumPy here."""
+        if self._depths is None:
+            heads = self.heads
+            n = len(heads)
+            depths = [-1] * n
+            depths[0] = 0
+            for i in range(1, n):
+                chain = []
+                while depths[i] == -1:
+                    chain.append(i)
+                    i = heads[i]
+                    if len(chain) > n:
+                        raise ValueError("Dependency cycle found")
+                depth = depths[i]
+                for j in reversed(chain):
+                    depth += 1
+                    depths[j] = depth
+            self._depths = array('i', depths)
+        return self._depths
+
+    def lca_index(self):
+        """Returns (depths, jumps), built on first use and cached:
+        depths[i] is the number of edges between i and the root,
+        jumps[k][i] is the 2**k-th ancestor of i (the root is its own
+        ancestor)."""
+        if self._lca_index is None:
+            heads = self.heads
+            n = len(heads)
+            depths = self.depths
+            jumps = [array('i', heads)]
+            jumps[0][0] = 0
+            for _ in range(1, max(depths).bit_length()):
+                prev = jumps[-1]
+                jumps.append(array('i', [prev[prev[i]] for i in range(n)]))
+            self._lca_index = (depths, jumps)
+        return self._lca_index
+
+    def lca(self, node1, node2):
+        """Returns the position of the lowest common ancestor of two nodes
+        using binary lifting."""
+        i = self.node_index(node1)
+        j = self.node_index(node2)
+        depths, jumps = self.lca_index()
+        if depths[i] < depths[j]:
+            i, j = j, i
+        diff = depths[i] - depths[j]
+        k = 0
+        while diff:
+            if diff & 1:
+                i = jumps[k][i]
+            diff >>= 1
+            k += 1
+        if i == j:
+            return i
+        for jump in reversed(jumps):
+            if jump[i] != jump[j]:
+                i = jump[i]
+                j = jump[j]
+        return jumps[0][i]
+
+    def path_positions(self, node1, node2):
+        """Returns the positions whose head edges form the path between
+        two nodes: those climbed from node1 to the lowest common ancestor
+        and those descended from it to node2."""
+        top = self.lca(node1, node2)
+        heads = self.heads
+        up = []
+        i = int(node1)
+        while i != top:
+            up.append(i)
+            i = heads[i]
+        down = []
+        j = int(node2)
+        while j != top:
+            down.append(j)
+            j = heads[j]
+        down.reverse()
+        return up, down
+
+    def path(self, node1, node2):
+        """Returns the labelled path between two nodes in the format
+        of get_path: relation_up labels from node1 to the lowest common
+        ancestor followed by relation_down labels to node2."""
+        up, down = self.path_positions(node1, node2)
+        return ([self.edge_label(i) + '_up' for i in up] +
+                [self.edge_label(j) + '_down' for j in down])
+
+    def relation_path(self, node1, node2):
+        """Returns the directionless path between two nodes as a tuple
+        of relation ids, the integer counterpart of
+        strip_directions(get_path(node1, node2, tree))."""
+        if node1 == node2:
+            return ()
+        up, down = self.path_positions(node1, node2)
+        relation_ids = self.relation_ids
+        return tuple(int(relation_ids[i]) for i in up + down)
+
+
+class PathVocabulary:
+    """Interns directionless paths (sequences of relation labels) to
+    consecutive integer ids. Paths are kept as tuples of relation ids;
+    strings are only built on output with to_str."""
+
+    def __init__(self):
+        self.paths = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def intern(self, relation_path):
+        """Returns the id of a path given as a tuple of relation ids."""
+        path_id = self._ids.get(relation_path)
+        if path_id is None:
+            path_id = self._ids[relation_path] = len(self.paths)
+            self.paths.append(relation_path)
+        return path_id
+
+    def intern_labels(self, labels):
+        """Returns the id of a path given as a sequence of relation labels."""
+        return self.intern(tuple(
+            _intern(label, RELATIONS, _relation_ids) for label in labels))
+
+    def intern_str(self, path_str):
+        """Returns the id of a path in the '->'-joined string format."""
+        return self.intern_labels(path_str.split('->') if path_str else [])
+
+    def labels(self, path_id):
+        return tuple(RELATIONS[r] for r in self.paths[path_id])
+
+    def to_str(self, path_id):
+        return '->'.join(self.labels(path_id))
+
+
+class PathPairCounter:
+    """Counts (source path id, target path id) pairs. Each pair is
+    packed into a single integer key, which is smaller and cheaper to
+    hash than a tuple. Iteration follows the order of first insertion."""
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, source_id, target_id, n=1):
+        self.counts[(source_id << 32) | target_id] += n
+
+    def __getitem__(self, pair):
+        source_id, target_id = pair
+        return self.counts[(source_id << 32) | target_id]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def items(self):
+        for key, val in self.counts.items():
+            yield (key >> 32, key & 0xFFFFFFFF), val
+
+    def to_counter(self, source_vocab, target_vocab=None):
+        """Returns a Counter keyed by (source path, target path) strings."""
+        if target_vocab is None:
+            target_vocab = source_vocab
+        return Counter({
+            (source_vocab.to_str(s), target_vocab.to_str(t)): val
+            for (s, t), val in self.items()
+        })
+
+
+def iter_conllu(source):
+    """Reads a CoNLL-U file line by line and yields a
+    (document_id, sentence_id, block) tuple for every sentence, where
+    block is the sentence's CoNLL-U text including comments. `source` is
+    a path or an open text file. Only the current sentence is held in
+    memory. The document id carries over from the last '# newdoc id'
+    comment and is empty for files without them."""
+    if isinstance(source, str):
+        with open(source, 'r', encoding='utf-8') as inp:
+            yield from iter_conllu(inp)
+        return
+    doc_id = ''
+    sent_id = ''
+    lines = []
+    for line in source:
+        line = line.rstrip('\n')
+        if line.strip():
+            if line.startswith('# newdoc id') or line.startswith('# newdoc_id'):
+                doc_id = line.split(' = ')[1]
+            elif line.startswith('# sent_id') and not sent_id:
+                sent_id = line.split(' = ')[1]
+            lines.append(line)
+        elif lines:
+            yield doc_id, sent_id, '\n'.join(lines)
+            sent_id = ''
+            lines = []
+    if lines:
+        yield doc_id, sent_id, '\n'.join(lines)
+
+
+def conll2tree(record):
+    """Converts a sentence in CoNLL-U format to a SentenceTree.
+    Multiword-token lines and empty nodes are skipped, as in conll2graph."""
+    heads = array('i', [-1])
+    relation_ids = array('H', [_intern('', RELATIONS, _relation_ids)])
+    pos_ids = array('H', [_intern('', POS_TAGS, _pos_ids)])
+    forms = ['']
+    for line in record.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = line.strip('\n').split('\t')
+        key = fields[0]
+        if '-' in key or '.' in key:
+            continue
+        if int(key) != len(forms):
+            raise ValueError(f"Non-consecutive token id: {key}")
+        forms.append(fields[1])
+        pos_ids.append(_intern(fields[3], POS_TAGS, _pos_ids))
+        heads.append(int(fields[6]))
+        relation_ids.append(_intern(fields[7], RELATIONS, _relation_ids))
+    for head in heads[1:]:
+        if not 0 <= head < len(heads):
+            raise ValueError(f"Head out of range: {head}")
+    return SentenceTree(heads, relation_ids, pos_ids, tuple(forms))
+
+
 def get_node_depth(node, graph):
-    """A BFS-based implementation."""
-    cur_depth = 0
-    q = Queue()
-    q.put(('0',0))
+    """Returns the number of edges between the node and the root.
+    Adjacency-list graphs are handled with BFS, SentenceTrees by following
+    head pointers."""
+    if isinstance(graph, SentenceTree):
+        return int(graph.depths[graph.node_index(node)])
+    q = deque([('0', 0)])
     visited = set()
     visited.add('0')
-    while not q.empty():
-        current_node, current_depth = q.get()
+    while q:
+        current_node, current_depth = q.popleft()
         for neighbour, *_ in graph[current_node]:
             if neighbour == node:
                 return current_depth+1
             elif neighbour not in visited:
-                q.put((neighbour, current_depth+1))
+                q.append((neighbour, current_depth+1))
             visited.add(neighbour)
     raise IndexError("Target node unreachable")
 
 
+def argmin_depth(keys, tree):
+    """Returns the position in `keys` of the node closest to the root
+    of a SentenceTree. Ties go to the earliest key."""
+    if not len(keys):
+        raise ValueError("No nodes to choose from")
+    depths = tree.depths
+    positions = [depths[tree.node_index(k)] for k in keys]
+    return min(range(len(positions)), key=positions.__getitem__)
+
+
 def highest_or_none(indices, graph):
     if indices[0] == 'X':
         return None
+    if isinstance(graph, SentenceTree):
+        return str(indices[argmin_depth(indices, graph)])
     min_depth = 1000
     argmin = None
     for i in indices:
@@ -78,18 +432,19 @@ def highest_or_none(indices, graph):
 def get_path(node1, node2, graph):
     if node1 == node2:
         return []
+    if isinstance(graph, SentenceTree):
+        return graph.path(node1, node2)
     
     # BFS with edge labels for paths
-    q = Queue()
+    q = deque([node1])
     # Remembers where we came from and the edge label
     sources = {}
     
-    q.put(node1)
     visited = set()
     visited.add(node1)
     
-    while not q.empty():
-        current = q.get()
+    while q:
+        current = q.popleft()
         for neighbour, relation, direction in graph[current]:
             if neighbour == node2:
                 path = [relation+'_'+direction]
@@ -101,12 +456,209 @@ def get_path(node1, node2, graph):
                 return list(reversed(path))
             elif neighbour not in visited:
                 sources[neighbour] = (current, relation, direction)
-                q.put(neighbour)
+                q.append(neighbour)
             visited.add(neighbour)
             
     raise ValueError("UD graph is not connected.")
 
 
+class ContingencyMatrix:
+    """A sparse source x target count matrix in coordinate form: entry i
+    says that source row rows[i] co-occurred counts[i] times with target
+    column cols[i]. Entries keep the order in which the pairs were first
+    counted, which breaks ties between equally frequent targets the same
+    way Counter.most_common does.
+
+    A row-compressed view (csr) is built on first use for row lookups
+    and slicing; dense arrays and data frames are only made on request.
+    save/load keep matrices in compressed .npz files."""
+
+    def __init__(self, rows, cols, counts, row_labels, col_labels):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.row_labels = row_labels
+        self.col_labels = col_labels
+        self._csr = None
+        self._row_ids = None
+
+    @classmethod
+    def from_pairs(cls, items):
+        """Builds the matrix from unique ((source, target), count) items,
+        e.g. Counter.items() or PathPairCounter.items(). Rows and columns
+        are numbered in order of first appearance."""
+        row_labels, row_ids = [], {}
+        col_labels, col_ids = [], {}
+        rows, cols, counts = [], [], []
+        for (source, target), val in items:
+            rows.append(_intern(source, row_labels, row_ids))
+            cols.append(_intern(target, col_labels, col_ids))
+            counts.append(val)
+        return cls(rows, cols, counts, row_labels, col_labels)
+
+    @classmethod
+    def from_confusion_dict(cls, confusion_dict):
+        """Builds the matrix from a map[source -> Counter[target -> int]]."""
+        return cls.from_pairs(
+            ((source, target), val)
+            for source, counter in confusion_dict.items()
+            for target, val in counter.items())
+
+    @classmethod
+    def from_dense(cls, matrix, row_labels, col_labels):
+        """Builds the matrix from the non-zero cells of a 2-d array. If a
+        column label occurs more than once, only its first column is
+        used (the dense tables written by the confusion matrix notebook
+        repeat the row labels among the columns); raises ValueError if
+        the repeated columns differ from it."""
+        matrix = np.asarray(matrix)
+        first = {}
+        for j, label in enumerate(col_labels):
+            i = first.setdefault(label, j)
+            if i != j and not np.array_equal(matrix[:, i], matrix[:, j]):
+                raise ValueError(f'Columns {i} and {j} ({label}) differ')
+        keep = np.array(sorted(first.values()), dtype=np.int64)
+        rows, cols = np.nonzero(matrix[:, keep])
+        return cls(rows, cols, matrix[:, keep][rows, cols], list(row_labels),
+                   [col_labels[j] for j in keep])
+
+    @classmethod
+    def load(cls, path):
+        """Reads a matrix written by save."""
+        with np.load(path) as data:
+            indptr = data['indptr']
+            labels = json.loads(str(data['labels']))
+            rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            matrix = cls(rows, data['cols'], data['counts'],
+                         labels['rows'], labels['cols'])
+            matrix._csr = (indptr.astype(np.int64), matrix.cols, matrix.counts)
+        return matrix
+
+    def save(self, path):
+        """Writes the matrix in row-compressed form to a compressed .npz
+        file. Labels are stored as JSON, so they must be strings (or
+        other JSON values); entries within a row keep their order."""
+        indptr, cols, counts = self.csr()
+        np.savez_compressed(
+            path,
+            indptr=indptr,
+            cols=cols.astype(np.min_scalar_type(max(len(self.col_labels) - 1, 0))),
+            counts=counts.astype(np.min_scalar_type(int(counts.max(initial=0)))),
+            labels=np.array(json.dumps(
+                {'rows': self.row_labels, 'cols': self.col_labels},
+                ensure_ascii=False)))
+
+    @property
+    def shape(self):
+        return (len(self.row_labels), len(self.col_labels))
+
+    def csr(self):
+        """Returns (indptr, cols, counts): the entries sorted by row, those
+        of row i being at indptr[i]:indptr[i+1]."""
+        if self._csr is None:
+            order = np.argsort(self.rows, kind='stable')
+            indptr = np.zeros(self.shape[0] + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.rows, minlength=self.shape[0]), out=indptr[1:])
+            self._csr = (indptr, self.cols[order], self.counts[order])
+        return self._csr
+
+    def row_index(self, label):
+        if self._row_ids is None:
+            self._row_ids = {label: i for i, label in enumerate(self.row_labels)}
+        return self._row_ids[label]
+
+    def row(self, label):
+        """Returns a Counter of the targets of a source label, in the
+        order the pairs were first counted. Raises KeyError for unknown
+        labels."""
+        indptr, cols, counts = self.csr()
+        i = self.row_index(label)
+        return Counter({
+            self.col_labels[col]: n
+            for col, n in zip(cols[indptr[i]:indptr[i+1]].tolist(),
+                              counts[indptr[i]:indptr[i+1]].tolist())})
+
+    def select_rows(self, labels):
+        """Returns the matrix restricted to the given source labels, in
+        that order. Columns are kept as they are."""
+        indptr, cols, counts = self.csr()
+        ids = [self.row_index(label) for label in labels]
+        sizes = [indptr[i+1] - indptr[i] for i in ids]
+        positions = np.concatenate(
+            [np.arange(indptr[i], indptr[i+1]) for i in ids] or [np.zeros(0, dtype=np.int64)])
+        return ContingencyMatrix(
+            np.repeat(np.arange(len(ids)), sizes), cols[positions],
+            counts[positions], list(labels), self.col_labels)
+
+    def to_dense(self, rows=None):
+        """Dense count array; `rows` restricts it to some source labels."""
+        if rows is not None:
+            return self.select_rows(rows).to_dense()
+        matrix = np.zeros(self.shape, dtype=np.int64)
+        np.add.at(matrix, (self.rows, self.cols), self.counts)
+        return matrix
+
+    def to_frame(self, rows=None):
+        """to_dense as a pandas.DataFrame with labelled rows and columns."""
+        import pandas
+        return pandas.DataFrame(
+            self.to_dense(rows),
+            index=list(self.row_labels if rows is None else rows),
+            columns=self.col_labels)
+
+    def row_totals(self):
+        totals = np.zeros(self.shape[0], dtype=np.int64)
+        np.add.at(totals, self.rows, self.counts)
+        return totals
+
+    def row_entropies(self):
+        """Entropy (in bits) of the target distribution of every row."""
+        probs = self.counts / self.row_totals()[self.rows]
+        return np.bincount(
+            self.rows,
+            weights=-np.log2(probs) * probs,
+            minlength=self.shape[0])
+
+    def top_k(self, k=3):
+        """Returns (columns, probabilities), two arrays of shape (rows, k)
+        with the k most frequent targets of each row. Missing entries
+        have column -1 and probability 0."""
+        n_rows = self.shape[0]
+        order = np.lexsort((np.arange(len(self.counts)), -self.counts, self.rows))
+        rows = self.rows[order]
+        ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = ranks < k
+        top_cols = np.full((n_rows, k), -1, dtype=np.int64)
+        top_probs = np.zeros((n_rows, k))
+        top_cols[rows[keep], ranks[keep]] = self.cols[order][keep]
+        top_probs[rows[keep], ranks[keep]] = (
+            self.counts[order][keep] / self.row_totals()[rows[keep]])
+        return top_cols, top_probs
+
+
+def path_entropy_table(matrix, k=3, label=str):
+    """Computes per-source-path counts, entropies and the k most probable
+    target paths with their probabilities in one pass over a
+    ContingencyMatrix. `label` converts row and column labels to
+    strings. Returns a dict of columns (path, count, entropy, prob1..k,
+    path1..k) ready for pandas.DataFrame."""
+    totals = matrix.row_totals()
+    entropies = matrix.row_entropies()
+    top_cols, top_probs = matrix.top_k(k)
+    col_names = [label(c) for c in matrix.col_labels]
+    table = {
+        'path': [label(r) for r in matrix.row_labels],
+        'count': totals.tolist(),
+        'entropy': entropies.tolist()
+    }
+    for i in range(k):
+        table[f'prob{i+1}'] = top_probs[:, i].tolist()
+    for i in range(k):
+        table[f'path{i+1}'] = [
+            col_names[c] if c >= 0 else '' for c in top_cols[:, i]]
+    return table
+
+
 def one_to_one(alignments):
     en_degrees = Counter()
     fr_degrees = Counter()
@@ -127,17 +679,364 @@ def one_to_one(alignments):
     return result
 
 
+DATA_COLUMNS = ('document_id', 'sentence_id', 'en', 'ru', 'alignment', 'verified')
+
+
+def iter_data_for_lang(lang, columns=('en', 'ru', 'alignment'), verified=True,
+                       documents=None, dbpath='pud_current.db', batch_size=500,
+                       parse_alignments=True):
+    """Streams rows of the en-`lang` table as tuples of `columns` (any
+    of DATA_COLUMNS; the target side is always called 'ru'), fetching
+    them from the cursor `batch_size` at a time. verified=True/False
+    selects verified/unverified sentences, None all of them; documents
+    restricts the rows to an iterable of document ids. Alignments are
+    parsed from JSON row by row unless parse_alignments is False.
+    Table names are not escaped. Do not expose."""
+    columns = list(columns)
+    for column in columns:
+        if column not in DATA_COLUMNS:
+            raise ValueError(f'Unknown column: {column}')
+    conditions = []
+    params = []
+    if verified is not None:
+        conditions.append('`verified` = ?')
+        params.append(int(verified))
+    if documents is not None:
+        documents = list(documents)
+        conditions.append(f'`document_id` IN ({", ".join("?" * len(documents))})')
+        params.extend(documents)
+    query = f'SELECT {", ".join(f"`{c}`" for c in columns)} FROM `en-{lang}`'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    parse_at = columns.index('alignment') \
+        if parse_alignments and 'alignment' in columns else None
+    conn = sqlite3.connect(dbpath)
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if parse_at is not None:
+                    row = row[:parse_at] + (json.loads(row[parse_at]),) + row[parse_at+1:]
+                yield row
+    finally:
+        conn.close()
+
+
 def get_data_for_lang(lang, dbpath='pud_current.db'):
     "Not safe from SQL injection attacks. Do not expose."
-    conn = sqlite3.connect(dbpath)
-    cursor = conn.cursor()
     en = []
     ko = []
     alignments = []
-    for en_, ko_, alignment_str in cursor.execute(
-        f'SELECT `en`, `ru`, `alignment` FROM `en-{lang}` WHERE `verified` = 1'
-    ):
+    for en_, ko_, alignment in iter_data_for_lang(lang, dbpath=dbpath):
         en.append(en_)
         ko.append(ko_)
-        alignments.append(json.loads(alignment_str))
-    return (en, ko, alignments)
\ No newline at end of file
+        alignments.append(alignment)
+    return (en, ko, alignments)
+
+
+_english_trees = {}
+
+
+def get_english_trees(dbpath='pud.db'):
+    """Returns {(document_id, sentence_id): SentenceTree} for the English
+    side of a normalized database (the sentences_en table written by
+    populate_db.py). The English treebank is parsed once per database
+    file and shared by all language pairs; the cache is refreshed when
+    the file changes."""
+    stat = os.stat(dbpath)
+    key = os.path.abspath(dbpath)
+    cached = _english_trees.get(key)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    conn = sqlite3.connect(dbpath)
+    try:
+        trees = {
+            (document_id, sentence_id): conll2tree(en)
+            for document_id, sentence_id, en in conn.execute(
+                'SELECT `document_id`, `sentence_id`, `en` FROM `sentences_en`')
+        }
+    finally:
+        conn.close()
+    _english_trees[key] = ((stat.st_mtime_ns, stat.st_size), trees)
+    return trees
+
+# Binary treebank store. A compiled treebank is a single file with a
+# JSON header followed by flat arrays; it is memory-mapped on load, so
+# trees are served as views into the file without reparsing CoNLL-U.
+# Each sentence occupies len(tokens)+1 slots, slot 0 being the root.
+
+STORE_MAGIC = b'PUDSTORE1\n'
+STORE_SUFFIX = '.store'
+
+
+def _file_hash(path):
+    with open(path, 'rb') as inp:
+        return hashlib.sha1(inp.read()).hexdigest()
+
+
+def compile_treebank(path, store_path=None):
+    """Compiles a CoNLL-U file into a binary store next to it
+    (path + '.store' by default). Returns the store path."""
+    if store_path is None:
+        store_path = path + STORE_SUFFIX
+    source_hash = _file_hash(path)
+    heads = []
+    relation_ids = []
+    pos_ids = []
+    token_offsets = [0]
+    forms = []
+    form_offsets = [0]
+    ids = []
+    for doc_id, sent_id, block in iter_conllu(path):
+        tree = conll2tree(block)
+        heads.append(np.asarray(tree.heads, dtype=np.int32))
+        relation_ids.append(np.asarray(tree.relation_ids, dtype=np.uint16))
+        pos_ids.append(np.asarray(tree.pos_ids, dtype=np.uint16))
+        token_offsets.append(token_offsets[-1] + len(tree.heads))
+        encoded = '\t'.join(tree.forms).encode('utf-8')
+        forms.append(encoded)
+        form_offsets.append(form_offsets[-1] + len(encoded))
+        ids.append((doc_id, sent_id))
+    arrays = {
+        'token_offsets': np.array(token_offsets, dtype=np.int64),
+        'heads': np.concatenate(heads),
+        'relation_ids': np.concatenate(relation_ids),
+        'pos_ids': np.concatenate(pos_ids),
+        'form_offsets': np.array(form_offsets, dtype=np.int64),
+        'forms': np.frombuffer(b''.join(forms), dtype=np.uint8)
+    }
+    header = {
+        'source_hash': source_hash,
+        'relations': RELATIONS[:],
+        'pos_tags': POS_TAGS[:],
+        'ids': ids,
+        'arrays': {}
+    }
+    # Array offsets are relative to the end of the header, aligned to 8 bytes
+    offset = 0
+    for name, arr in arrays.items():
+        header['arrays'][name] = [arr.dtype.str, offset, len(arr)]
+        offset += -(-arr.nbytes // 8) * 8
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    header_bytes += b' ' * (-(len(STORE_MAGIC) + 8 + len(header_bytes)) % 8)
+    tmp_path = store_path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(STORE_MAGIC)
+        out.write(len(header_bytes).to_bytes(8, 'little'))
+        out.write(header_bytes)
+        for arr in arrays.values():
+            out.write(arr.tobytes())
+            out.write(b'\0' * (-arr.nbytes % 8))
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+class TreebankStore:
+    """A memory-mapped compiled treebank. Sentences are addressed by
+    position or by (document_id, sentence_id) and returned as
+    SentenceTrees whose arrays are views into the mapped file."""
+
+    def __init__(self, store_path):
+        with open(store_path, 'rb') as inp:
+            self._mmap = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError(f"Not a treebank store: {store_path}")
+        start = len(STORE_MAGIC)
+        header_len = int.from_bytes(self._mmap[start:start+8], 'little')
+        header = json.loads(self._mmap[start+8:start+8+header_len].decode('utf-8'))
+        data_start = start + 8 + header_len
+        self.source_hash = header['source_hash']
+        self.ids = [tuple(el) for el in header['ids']]
+        self._positions = {key: i for i, key in enumerate(self.ids)}
+        for name, (dtype, offset, length) in header['arrays'].items():
+            setattr(self, name, np.frombuffer(
+                self._mmap, dtype=dtype, count=length, offset=data_start+offset))
+        # Map the store's label ids to the ids of this process
+        self._relation_map = self._label_map(header['relations'], RELATIONS, _relation_ids)
+        self._pos_map = self._label_map(header['pos_tags'], POS_TAGS, _pos_ids)
+
+    @staticmethod
+    def _label_map(stored_labels, labels, ids):
+        label_map = np.array(
+            [_intern(label, labels, ids) for label in stored_labels],
+            dtype=np.uint16)
+        if np.array_equal(label_map, np.arange(len(label_map))):
+            return None
+        return label_map
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.tree(i)
+
+    def __iter__(self):
+        return (self.tree(i) for i in range(len(self)))
+
+    def position(self, document_id, sentence_id):
+        return self._positions[(document_id, sentence_id)]
+
+    def tree(self, i):
+        start, end = self.token_offsets[i], self.token_offsets[i+1]
+        relation_ids = self.relation_ids[start:end]
+        pos_ids = self.pos_ids[start:end]
+        if self._relation_map is not None:
+            relation_ids = self._relation_map[relation_ids]
+        if self._pos_map is not None:
+            pos_ids = self._pos_map[pos_ids]
+        forms = self.forms[self.form_offsets[i]:self.form_offsets[i+1]]
+        return SentenceTree(
+            self.heads[start:end],
+            relation_ids,
+            pos_ids,
+            tuple(forms.tobytes().decode('utf-8').split('\t')))
+
+    def tree_by_id(self, document_id, sentence_id):
+        return self.tree(self.position(document_id, sentence_id))
+
+
+def load_treebank(path):
+    """Returns a TreebankStore for a CoNLL-U file, compiling it first
+    if the store is missing or was built from different file contents."""
+    store_path = path + STORE_SUFFIX
+    if os.path.exists(store_path):
+        store = TreebankStore(store_path)
+        if store.source_hash == _file_hash(path):
+            return store
+    return TreebankStore(compile_treebank(path, store_path))
+
+
+# Opt-in instrumentation of the analysis scripts. Code that supports it
+# takes an `instr` argument and wraps its stages in instr.stage(name);
+# with the default NO_INSTRUMENTATION these are shared no-op context
+# managers, so an uninstrumented run pays one method call per stage and
+# sentence, not per node pair.
+
+class _StageTimer:
+    __slots__ = ('instr', 'name', 'key', 'start')
+
+    def __init__(self, instr, name, key=None):
+        self.instr = instr
+        self.name = name
+        self.key = key
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.start
+        if self.key is None:
+            self.instr.times[self.name] += elapsed
+            self.instr.calls[self.name] += 1
+        else:
+            self.instr.add_item(self.name, self.key, elapsed)
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class Instrumentation:
+    """Collects per-stage wall time and call counts, named counters
+    (e.g. sentences, pairs) and the slowest items (e.g. sentences) of a
+    run. summary() returns them with per-second rates of the counters
+    as a JSON-serialisable dict."""
+    enabled = True
+
+    def __init__(self, slowest=5):
+        self.times = Counter()
+        self.calls = Counter()
+        self.counts = Counter()
+        self.slowest = {}
+        self.n_slowest = slowest
+        self.start = perf_counter()
+
+    def stage(self, name):
+        return _StageTimer(self, name)
+
+    def item(self, kind, key):
+        """Times one item of a kind, e.g. item('sentence', sent_id)."""
+        return _StageTimer(self, kind, key)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def add_item(self, kind, key, elapsed):
+        items = self.slowest.setdefault(kind, [])
+        if len(items) < self.n_slowest or elapsed > items[-1][0]:
+            items.append((elapsed, key))
+            items.sort(key=lambda x: x[0], reverse=True)
+            del items[self.n_slowest:]
+
+    def summary(self):
+        wall_time = perf_counter() - self.start
+        return {
+            'wall_time': wall_time,
+            'stages': {
+                name: {'seconds': self.times[name], 'calls': self.calls[name]}
+                for name in self.times
+            },
+            'counters': dict(self.counts),
+            'rates': {
+                f'{name}_per_s': n / wall_time for name, n in self.counts.items()
+            },
+            'slowest': {
+                kind: [{'key': key, 'seconds': elapsed} for elapsed, key in items]
+                for kind, items in self.slowest.items()
+            }
+        }
+
+    def write_summary(self, path):
+        """Writes the summary as JSON to a file, or to stderr for '-'."""
+        if path == '-':
+            json.dump(self.summary(), sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        else:
+            with open(path, 'w') as out:
+                json.dump(self.summary(), out, indent=2)
+
+
+class _NoInstrumentation:
+    enabled = False
+
+    def stage(self, name):
+        return _NO_STAGE
+
+    def item(self, kind, key):
+        return _NO_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+
+NO_INSTRUMENTATION = _NoInstrumentation()
+
+
+@contextmanager
+def profiled(path=None):
+    """Runs the body under cProfile and dumps the statistics to `path`
+    (for pstats or snakeviz). Does nothing if path is None."""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
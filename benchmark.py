@@ -0,0 +1,480 @@
+# Benchmarks of the parsing, path and entropy code on the bundled PUD
+# treebanks and the en-ru alignments. The corpus can be replicated to
+# measure scaling (--scale 1 10 100). Results are written as JSON;
+# --compare prints the change against an earlier results file and
+# exits with status 1 if anything got slower than --threshold allows.
+#
+# Usage: benchmark.py [--scale N ...] [--repeat R] [--only NAME ...]
+#                     [--out results.json] [--compare old.json [new.json]]
+#                     [--max-unprocessable 0.05]
+#
+# The en-ru table is built with populate_db.py in a temporary directory;
+# sentences whose alignment create_arrays.py cannot process stay
+# unverified, so that all benchmarks see the same verified workload.
+# They are listed on stderr and in the results; if more than
+# --max-unprocessable of them (a fraction) fail, the alignments are most
+# likely attached to the wrong sentences and the run stops.
+#
+# get_path, relation_path and legacy_get_path query the node pairs that
+# create_arrays.py extracts paths for from the verified sentences.
+#
+# Benchmarks named legacy_* measure the adjacency-list (conll2graph)
+# code that the pipeline no longer uses; they are kept as baselines for
+# the SentenceTree code.
+
+import gc
+import io
+import os
+import sys
+import json
+import sqlite3
+import platform
+import subprocess
+import tempfile
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from itertools import combinations
+from statistics import median
+from sys import exit
+from time import perf_counter
+
+import numpy as np
+import pandas
+from sqlalchemy import create_engine
+
+import create_arrays
+import PUDAnalisysLib as PAL
+
+from populate_db import aligned_sentences, populate_table
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TABLE = 'en-ru'
+REPORT_PATHS = ['obj', 'nsubj', 'amod']
+
+
+def repo_file(name):
+    return os.path.join(REPO_DIR, name)
+
+
+def scaled_rows(rows, scale):
+    """Replicates (document_id, sentence_id, en, ru, alignment) rows;
+    copies get ids with a ~k suffix so that they stay unique."""
+    for k in range(scale):
+        suffix = f'~{k}' if k else ''
+        for doc_id, sent_id, en, ru, alignment in rows:
+            yield (doc_id + suffix, sent_id + suffix, en, ru, alignment)
+
+
+def processing_error(record):
+    """Returns why create_arrays.py cannot process a record, or None."""
+    try:
+        create_arrays.count_paths([record])
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return None
+
+
+def processable(record):
+    return processing_error(record) is None
+
+
+def prepare_workload():
+    """Pairs English and Russian with the en-ru alignments and finds the
+    sentences that the path pipeline can process. Returns the rows,
+    their verification flags and a list of (document_id, sentence_id,
+    error) for the others."""
+    rows = list(aligned_sentences(
+        repo_file('en_pud-ud-test.conllu'),
+        repo_file('ru_pud-ud-test.conllu'),
+        repo_file('en-ru.align')))
+    errors = [processing_error((None, None) + row[2:]) for row in rows]
+    unprocessable = [
+        (row[0], row[1], error) for row, error in zip(rows, errors) if error is not None]
+    return rows, [error is None for error in errors], unprocessable
+
+
+def build_db(path, rows, verified, scale):
+    if os.path.exists(path):
+        os.remove(path)
+    populate_table(create_engine(f'sqlite:///{path}'), TABLE,
+                   scaled_rows(rows, scale), normalized=False)
+    conn = sqlite3.connect(path)
+    keys = [(doc_id, sent_id)
+            for doc_id, sent_id, *_ in scaled_rows(rows, scale)]
+    flags = verified * scale
+    conn.executemany(
+        f'UPDATE `{TABLE}` SET `verified` = 1 WHERE `document_id` = ? AND `sentence_id` = ?',
+        [key for key, flag in zip(keys, flags) if flag])
+    conn.commit()
+    conn.close()
+
+
+def timed(fn, repeat):
+    """Runs fn `repeat` times and returns (times, last result)."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = perf_counter()
+        result = fn()
+        times.append(perf_counter() - start)
+    return times, result
+
+
+# Benchmarks take the workload of one scale and return (items, fn),
+# where fn does the measured work on `items` units.
+
+def bench_conll2tree(w):
+    blocks = w['blocks']
+    return len(blocks), lambda: [PAL.conll2tree(b) for b in blocks]
+
+
+def bench_legacy_conll2graph(w):
+    blocks = w['blocks']
+    return len(blocks), lambda: [PAL.conll2graph(b) for b in blocks]
+
+
+def fresh_trees(w):
+    """Unparsed copies of the trees; depths and LCA indexes are built
+    lazily, so measurements on cached trees would not include them."""
+    return [PAL.SentenceTree(t.heads, t.relation_ids, t.pos_ids, t.forms)
+            for t in w['trees']]
+
+
+def bench_get_node_depth(w):
+    def run():
+        for tree in fresh_trees(w):
+            for node in tree:
+                PAL.get_node_depth(node, tree)
+    return sum(len(tree) for tree in w['trees']), run
+
+
+def bench_legacy_get_node_depth(w):
+    graphs = w['graphs']
+    def run():
+        for nodes, graph in graphs:
+            for node in nodes:
+                PAL.get_node_depth(node, graph)
+    return sum(len(nodes) for nodes, _ in graphs), run
+
+
+def aligned_pairs(w):
+    """(position of a tree in w['trees'], node1, node2) for the node
+    pairs whose paths create_arrays.py extracts: all pairs of aligned
+    English nodes, and the target counterparts of the pairs that are
+    joined by a single edge. Computed once per workload."""
+    if 'aligned_pairs' in w:
+        return w['aligned_pairs']
+    pairs = []
+    trees = w['trees']
+    for en_position, alignment in w['alignments']:
+        en_tree, target_tree = trees[en_position], trees[en_position + 1]
+        _, _, one_to_many_en, one_to_many_fr, edges = create_arrays.preprocess_alignment(alignment)
+        for node_fr, nodes_en in one_to_many_fr.items():
+            edges.append((create_arrays.get_minimum_depth_node(nodes_en, en_tree), node_fr))
+        for node_en, nodes_fr in one_to_many_en.items():
+            edges.append((node_en, create_arrays.get_minimum_depth_node(nodes_fr, target_tree)))
+        edges.sort(key = lambda x: int(x[0]))
+        for p, q in combinations(edges, 2):
+            en1, fr1 = map(create_arrays.normalise_key, p)
+            en2, fr2 = map(create_arrays.normalise_key, q)
+            if target_tree[fr1]['pos'] == 'CCONJ' or target_tree[fr2]['pos'] == 'CCONJ':
+                continue
+            pairs.append((en_position, en1, en2))
+            if len(en_tree.relation_path(en1, en2)) == 1:
+                pairs.append((en_position + 1, fr1, fr2))
+    w['aligned_pairs'] = pairs
+    return pairs
+
+
+def bench_get_path(w):
+    pairs = aligned_pairs(w)
+    def run():
+        trees = fresh_trees(w)
+        for position, node1, node2 in pairs:
+            PAL.get_path(node1, node2, trees[position])
+    return len(pairs), run
+
+
+def bench_relation_path(w):
+    """The integer paths that create_arrays.py counts."""
+    pairs = aligned_pairs(w)
+    def run():
+        trees = fresh_trees(w)
+        for position, node1, node2 in pairs:
+            trees[position].relation_path(node1, node2)
+    return len(pairs), run
+
+
+def bench_legacy_get_path(w):
+    pairs = [(w['graphs'][position][1], node1, node2)
+             for position, node1, node2 in aligned_pairs(w)]
+    def run():
+        for graph, node1, node2 in pairs:
+            PAL.get_path(node1, node2, graph)
+    return len(pairs), run
+
+
+def one_to_many_groups(w):
+    """(position of a tree in w['trees'], node keys) for the one-to-many
+    alignment groups that create_arrays.py resolves to their highest
+    node."""
+    groups = []
+    for en_position, alignment in w['alignments']:
+        _, _, one_to_many_en, one_to_many_fr, _ = create_arrays.preprocess_alignment(alignment)
+        groups.extend(
+            (en_position + 1, list(map(create_arrays.normalise_key, nodes)))
+            for nodes in one_to_many_en.values())
+        groups.extend(
+            (en_position, list(map(create_arrays.normalise_key, nodes)))
+            for nodes in one_to_many_fr.values())
+    return groups
+
+
+def bench_highest_or_none(w):
+    groups = one_to_many_groups(w)
+    def run():
+        trees = fresh_trees(w)
+        for position, nodes in groups:
+            PAL.highest_or_none(nodes, trees[position])
+    return len(groups), run
+
+
+def bench_legacy_highest_or_none(w):
+    groups = [(w['graphs'][position][1], nodes)
+              for position, nodes in one_to_many_groups(w)]
+    def run():
+        for graph, nodes in groups:
+            PAL.highest_or_none(nodes, graph)
+    return len(groups), run
+
+
+def bench_preprocess_alignment(w):
+    alignments = [record[4] for record in w['records']]
+    return len(alignments), lambda: [
+        create_arrays.preprocess_alignment(a) for a in alignments]
+
+
+def bench_path_entropy_table(w):
+    matrix, vocab = create_arrays.path_matrix(w['records'])
+    return matrix.shape[0], lambda: PAL.path_entropy_table(matrix, label=vocab.to_str)
+
+
+def bench_legacy_entropy_for_path(w):
+    path_ids, vocab, single_edge_paths = create_arrays.count_paths(w['records'])
+    counter = path_ids.to_counter(vocab)
+    paths = [vocab.to_str(p) for p in single_edge_paths]
+    return len(paths), lambda: [
+        create_arrays.entropy_for_path(p, counter) for p in paths]
+
+
+def bench_create_arrays(w):
+    db_path = w['db']
+    out_path = os.path.join(os.path.dirname(db_path), 'path-entropies.csv')
+    def run():
+        conn = sqlite3.connect(db_path)
+        records = list(conn.execute(f'SELECT * FROM `{TABLE}` WHERE `verified` = 1'))
+        conn.close()
+        pandas.DataFrame(create_arrays.path_entropies(records)).to_csv(out_path, index=False)
+    return len(w['records']), run
+
+
+def bench_build_path_index(w):
+    rpm = w['report_path_mappings']
+    def run():
+        rpm._path_indexes.clear()
+        rpm.build_path_index(TABLE)
+    return w['n_rows'], run
+
+
+def bench_get_edge_label_report(w):
+    rpm = w['report_path_mappings']
+    rpm.load_path_index(TABLE) # Not part of the measurement
+    def run():
+        with redirect_stdout(io.StringIO()):
+            for path in REPORT_PATHS:
+                rpm.get_edge_label_report(TABLE, path)
+    return len(REPORT_PATHS), run
+
+
+BENCHMARKS = {
+    'conll2tree': bench_conll2tree,
+    'get_node_depth': bench_get_node_depth,
+    'get_path': bench_get_path,
+    'relation_path': bench_relation_path,
+    'highest_or_none': bench_highest_or_none,
+    'preprocess_alignment': bench_preprocess_alignment,
+    'path_entropy_table': bench_path_entropy_table,
+    'create_arrays': bench_create_arrays,
+    'build_path_index': bench_build_path_index,
+    'get_edge_label_report': bench_get_edge_label_report,
+    'legacy_conll2graph': bench_legacy_conll2graph,
+    'legacy_get_node_depth': bench_legacy_get_node_depth,
+    'legacy_get_path': bench_legacy_get_path,
+    'legacy_highest_or_none': bench_legacy_highest_or_none,
+    'legacy_entropy_for_path': bench_legacy_entropy_for_path,
+}
+
+
+def make_workload(rows, verified, trees, graphs, scale, workdir, rpm):
+    """Builds the database of a scale. In-memory inputs are the same
+    objects repeated `scale` times, so memory use stays flat."""
+    db_path = os.path.join(workdir, f'pud-{scale}x.db')
+    build_db(db_path, rows, verified, scale)
+    # report_path_mappings works on the database it was imported with
+    rpm.conn.close()
+    rpm.fname = db_path
+    rpm.conn = sqlite3.connect(db_path)
+    rpm.cursor = rpm.conn.cursor()
+    rpm._path_indexes.clear()
+    records = [
+        row[:5] for row, flag in zip(scaled_rows(rows, scale), verified * scale) if flag]
+    # trees and graphs hold English and target of row i of copy k at
+    # 2(k * len(rows) + i) and the position after it
+    alignments = [
+        (2 * (k * len(rows) + i), row[4])
+        for k in range(scale)
+        for i, (row, flag) in enumerate(zip(rows, verified)) if flag]
+    return {
+        'db': db_path,
+        'n_rows': len(rows) * scale,
+        'records': records,
+        'blocks': [b for row in rows for b in row[2:4]] * scale,
+        'trees': trees * scale,
+        'graphs': graphs * scale,
+        'alignments': alignments,
+        'report_path_mappings': rpm
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scales(rows, verified, trees, graphs, scales, repeat, names, workdir, rpm, results):
+    for scale in scales:
+        workload = make_workload(rows, verified, trees, graphs, scale, workdir, rpm)
+        for name in names:
+            items, fn = BENCHMARKS[name](workload)
+            times, _ = timed(fn, repeat)
+            key = f'{name}@{scale}x'
+            results[key] = {
+                'benchmark': name,
+                'scale': scale,
+                'items': items,
+                'times': times,
+                'min': min(times),
+                'median': median(times),
+                'per_item': median(times) / items if items else None
+            }
+            print(f'{key:32} {median(times):10.4f}s  ({items} items)')
+
+
+def report_unprocessable(unprocessable, n_rows, max_fraction):
+    """Lists the sentences left unverified on stderr. Raises ValueError
+    if there are more than max_fraction of them."""
+    for document_id, sentence_id, error in unprocessable:
+        print(f'unprocessable: {document_id}/{sentence_id}: {error}', file=sys.stderr)
+    if len(unprocessable) > max_fraction * n_rows:
+        raise ValueError(
+            f'{len(unprocessable)} of {n_rows} sentences cannot be processed; '
+            'are the alignments attached to the right sentences?')
+
+
+def run_benchmarks(scales, repeat, only, max_unprocessable=0.05):
+    names = only or list(BENCHMARKS)
+    results = {}
+    rows, verified, unprocessable = prepare_workload()
+    report_unprocessable(unprocessable, len(rows), max_unprocessable)
+    trees = [PAL.conll2tree(b) for row in rows for b in row[2:4]]
+    graphs = [PAL.conll2graph(b) for row in rows for b in row[2:4]]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='pud-benchmark-') as workdir:
+        os.chdir(workdir)
+        try:
+            # Connects to pud.db in the current directory on import
+            import report_path_mappings as rpm
+            run_scales(rows, verified, trees, graphs, scales, repeat, names, workdir, rpm, results)
+            rpm.conn.close()
+        finally:
+            os.chdir(cwd)
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'repeat': repeat,
+            'verified_sentences': sum(verified),
+            'unprocessable_sentences': [
+                {'document_id': document_id, 'sentence_id': sentence_id, 'error': error}
+                for document_id, sentence_id, error in unprocessable]
+        },
+        'results': results
+    }
+
+
+def compare(old, new, threshold):
+    """Prints the best times of both runs side by side (the minimum is
+    the least noisy estimate). Returns the names of the benchmarks that
+    got slower by more than `threshold` (a ratio)."""
+    regressions = []
+    print(f'{"benchmark":32} {"old":>10} {"new":>10} {"ratio":>7}')
+    for key, result in new['results'].items():
+        before = old['results'].get(key)
+        if before is None:
+            print(f'{key:32} {"-":>10} {result["min"]:10.4f}')
+            continue
+        ratio = result['min'] / before['min']
+        mark = ''
+        if ratio > threshold:
+            mark = '  slower'
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            mark = '  faster'
+        print(f'{key:32} {before["min"]:10.4f} {result["min"]:10.4f} {ratio:7.2f}{mark}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--scale', type=int, nargs='+', default=[1],
+                        help='corpus size multipliers, e.g. 1 10 100')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='old results file, and optionally new results instead of a run')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--max-unprocessable', type=float, default=0.05,
+                        help='fraction of sentences that may fail the path pipeline')
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        exit('--compare takes an old and optionally a new results file')
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as inp:
+            new = json.load(inp)
+    else:
+        try:
+            new = run_benchmarks(args.scale, args.repeat, args.only, args.max_unprocessable)
+        except ValueError as e:
+            exit(str(e))
+        with open(args.out, 'w') as out:
+            json.dump(new, out, indent=2)
+        print(f'Results written to {args.out}')
+    if args.compare:
+        with open(args.compare[0]) as inp:
+            old = json.load(inp)
+        if compare(old, new, args.threshold):
+            exit(1)
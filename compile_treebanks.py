@@ -0,0 +1,14 @@
+# Compiles CoNLL-U treebanks into memory-mapped binary stores
+# (see PUDAnalisysLib.load_treebank). Accepts file names as arguments;
+# compiles all PUD treebanks in the current directory by default.
+# Stores that are up to date with their source files are left alone.
+
+from glob import glob
+from sys import argv
+
+from PUDAnalisysLib import load_treebank
+
+paths = argv[1:] or sorted(glob('*_pud-ud-test.conllu'))
+for path in paths:
+    store = load_treebank(path)
+    print(f'{path}: {len(store)} sentences, {len(store.heads) - len(store)} tokens')
@@ -0,0 +1,75 @@
+# Sparse storage of source x target confusion matrices (en_fr_paths.csv,
+# en_ru_pos.csv, ...). The dense tables are almost all zeros; convert
+# stores them as compressed row-compressed .npz files (see
+# ContingencyMatrix.save), which load in milliseconds. The other
+# commands export a stored matrix as text:
+#
+#   dense    -- the dense table, optionally only some source rows
+#   triples  -- one source,target,count line per non-zero cell, which
+#               is compact and diffs line by line
+#
+# Usage: confusion_matrices.py convert <table.csv> ...
+#        confusion_matrices.py dense <matrix.npz> [source ...]
+#        confusion_matrices.py triples <matrix.npz>
+
+import csv
+import os
+import sys
+import numpy as np
+
+from sys import argv, exit
+
+from PUDAnalisysLib import ContingencyMatrix
+
+
+def read_dense_csv(path):
+    """Reads a dense table with source labels in the first column and
+    target labels in the header. Repeated target columns are read once
+    (see ContingencyMatrix.from_dense)."""
+    with open(path, 'r', encoding='utf-8', newline='') as inp:
+        reader = csv.reader(inp)
+        header = next(reader)
+        row_labels = []
+        rows = []
+        for line in reader:
+            row_labels.append(line[0])
+            rows.append([int(val) for val in line[1:]])
+    matrix = np.array(rows, dtype=np.int64).reshape(len(rows), len(header) - 1)
+    return ContingencyMatrix.from_dense(matrix, row_labels, header[1:])
+
+
+def write_triples(matrix, out):
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['source', 'target', 'count'])
+    indptr, cols, counts = matrix.csr()
+    for i, source in enumerate(matrix.row_labels):
+        for col, n in zip(cols[indptr[i]:indptr[i+1]].tolist(),
+                          counts[indptr[i]:indptr[i+1]].tolist()):
+            writer.writerow([source, matrix.col_labels[col], n])
+
+
+if __name__ == '__main__':
+    if len(argv) < 3 or argv[1] not in {'convert', 'dense', 'triples'}:
+        exit('Usage: confusion_matrices.py convert|dense|triples <file> ...')
+    command = argv[1]
+    if command == 'convert':
+        for path in argv[2:]:
+            try:
+                matrix = read_dense_csv(path)
+            except ValueError as e:
+                exit(f'{path}: {e}')
+            out_path = os.path.splitext(path)[0] + '.npz'
+            matrix.save(out_path)
+            print(f'{path}: {matrix.shape[0]} x {matrix.shape[1]}, '
+                  f'{len(matrix.counts)} non-zero cells, '
+                  f'{os.path.getsize(path)} -> {os.path.getsize(out_path)} bytes')
+    else:
+        matrix = ContingencyMatrix.load(argv[2])
+        if command == 'dense':
+            try:
+                frame = matrix.to_frame(argv[3:] or None)
+            except KeyError as e:
+                exit(f'Unknown source label: {e}')
+            frame.to_csv(sys.stdout)
+        else:
+            write_triples(matrix, sys.stdout)
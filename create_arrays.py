@@ -5,14 +5,20 @@ import pymorphy2
 import json
 import pandas
 
+from argparse import ArgumentParser
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations as combs
-from queue import SimpleQueue
-from sys import argv
 from math import log2
 from pprint import pprint
 from sys import exit
 
+from PUDAnalisysLib import (conll2tree, argmin_depth,
+                            PathVocabulary, PathPairCounter,
+                            ContingencyMatrix, path_entropy_table,
+                            get_english_trees, Instrumentation,
+                            NO_INSTRUMENTATION, profiled)
+
 def normalise_key(k):
     """Converts 0-based indexing to 1-based indexing."""
     return str(int(k)+1)
@@ -23,38 +29,6 @@ def strip_directions(path):
     return list(map(lambda x: x.split('_')[0], path))
 
 
-def conll2graph(record):
-    """Converts sentences described using CoNLL-U format 
-    (http://universaldependencies.org/format.html) to graphs. 
-    Returns a dictionary of nodes (wordforms and POS tags indexed 
-    by line numbers) together with a graph of the dependencies encoded 
-    as adjacency lists of (node_key, relation_label, direction[up or down]) tuples."""
-    graph = {}
-    nodes = {}
-    for line in record.splitlines():
-        if line.startswith('#'):
-            continue
-        fields = line.strip('\n').split('\t')
-        key = fields[0]
-        # Ignore compound surface keys for aux, du, etc.
-        if '-' in key:
-            continue
-        # lemma would be better, but there are no lemmas in Russian PUD
-        # take care of this at a later stage
-        wordform = fields[1] 
-        pos = fields[3]
-        parent = fields[6]
-        relation = fields[7]
-        nodes[key] = { 'wordform': wordform, 'pos': pos }
-        if key not in graph:
-            graph[key] = []
-        if parent not in graph:
-            graph[parent] = []
-        graph[key].append((parent, relation, 'up'))
-        graph[parent].append((key, relation, 'down'))
-    return (nodes, graph)
-
-
 def extract_raw_sentences(record):
     """Extracts target and source sentences from the target record."""
     lines = record[3].splitlines()
@@ -114,67 +88,10 @@ def preprocess_alignment(alignment_str):
     )
 
 
-def get_path(node1, node2, graph):
-    if node1 == node2:
-        return []
-    
-    # BFS with edge labels for paths
-    q = SimpleQueue()
-    # Remembers where we came from and the edge label
-    sources = {}
-    
-    q.put(node1)
-    visited = set()
-    visited.add(node1)
-    
-    while not q.empty():
-        current = q.get()
-        for neighbour, relation, direction in graph[current]:
-            if neighbour == node2:
-                path = [relation+'_'+direction]
-                source = current
-                while source != node1:
-                    prev_node, prev_relation, prev_direction = sources[source]
-                    path.append(prev_relation+'_'+prev_direction)
-                    source = prev_node
-                return list(reversed(path))
-            elif neighbour not in visited:
-                sources[neighbour] = (current, relation, direction)
-                q.put(neighbour)
-            visited.add(neighbour)
-            
-    raise ValueError("UD graph is not connected.")
-
-
-def get_node_depth(node, graph):
-    """A BFS-based implementation."""
-    cur_depth = 0
-    q = SimpleQueue()
-    q.put(('0',0))
-    visited = set()
-    visited.add('0')
-    while not q.empty():
-        current_node, current_depth = q.get()
-        for neighbour, *_ in graph[current_node]:
-            if neighbour == node:
-                return current_depth+1
-            elif neighbour not in visited:
-                q.put((neighbour, current_depth+1))
-            visited.add(neighbour)
-    raise IndexError("Target node unreachable")
-
-
 def get_minimum_depth_node(nodes, graph):
-    min_depth = 1000
-    arg_min = 'X'
-    for n in nodes:
-        current_depth = get_node_depth(normalise_key(n), graph)
-        if current_depth < min_depth:
-            min_depth = current_depth
-            arg_min = n
-    if arg_min == 'X':
-        raise ValueError("Minimum-depth node not found")
-    return arg_min
+    """Returns the node from a one-to-many alignment group
+    (0-based keys) that is closest to the root."""
+    return nodes[argmin_depth(list(map(normalise_key, nodes)), graph)]
 
 
 def entropy_for_path(path, input_counter):
@@ -200,24 +117,34 @@ def count_for_path(path, input_counter):
     return sum(1 for el in input_counter.elements() if el[0] == path)
 
 
-if __name__ == '__main__':
-    if len(argv) == 1:
-        fname = 'pud.db'
-    else:
-        fname = argv[1]
-    conn = sqlite3.connect(fname)
-    cursor = conn.cursor()
-    en_ru = [r for r in cursor.execute('select * from `en-ru` where `verified` = 1')]
-    print(len(en_ru))
-    en_fr = [r for r in cursor.execute('select * from `en-fr` where `verified` = 1')]
-    print(len(en_fr))
-
-    # Create French table
-    path_counter = Counter()
-    all_single_edge_paths = set()
-    for i, record in enumerate(en_ru):
-        en_n, en_g = conll2graph(record[2])
-        fr_n, fr_g = conll2graph(record[3])
+def count_paths(records, vocab=None, en_trees=None, instr=NO_INSTRUMENTATION):
+    """Counts (English single-edge path, target path) pairs over
+    verified records. Paths are interned in `vocab` (a new PathVocabulary
+    by default). English trees already parsed for another language pair
+    can be passed as en_trees, {(document_id, sentence_id): tree}.
+    Stages are timed and counted with `instr` (see Instrumentation).
+    Returns the PathPairCounter, the vocabulary and the ids of English
+    single-edge paths in order of first occurrence."""
+    if vocab is None:
+        vocab = PathVocabulary()
+    if en_trees is None:
+        en_trees = {}
+    path_counter = PathPairCounter()
+    all_single_edge_paths = {}
+    for record in records:
+        with instr.item('sentence', f'{record[0]}/{record[1]}'):
+            count_record_paths(
+                record, vocab, en_trees, path_counter, all_single_edge_paths, instr)
+    return path_counter, vocab, list(all_single_edge_paths)
+
+
+def count_record_paths(record, vocab, en_trees, path_counter, all_single_edge_paths, instr):
+    with instr.stage('parse'):
+        en_g = en_trees.get((record[0], record[1]))
+        if en_g is None:
+            en_g = conll2tree(record[2])
+        fr_g = conll2tree(record[3])
+    with instr.stage('preprocess_alignment'):
         (
             unaligned_en, 
             unaligned_fr, 
@@ -227,27 +154,8 @@ if __name__ == '__main__':
         ) = preprocess_alignment(record[4])
         source_sent, target_sent = extract_raw_sentences(record)
 
-    #     aligned_en = [normalise_key(el[1]) for el in alignment_edges] + [normalise_key(el[0]) for el in one_to_many_fr]
-    #     unaligned_en = [normalise_key(el) for el in unaligned_fr]
-    #     for aligned_node in aligned_en:
-    #         for unaligned_node in unaligned_en:
-    #             if int(aligned_node) < int(unaligned_node):
-    #                 path = get_path(aligned_node, unaligned_node, fr_g)
-    #             else:
-    #                 path = get_path(unaligned_node, aligned_node, fr_g)
-    #             if '->'.join(path) == 'punct_up':
-    #                 print(i+1)
-    #                 print(en_n)
-    #                 print("Aligned:", aligned_node, en_n[aligned_node])
-    #                 print("Unaligned:", unaligned_node, en_n[unaligned_node])
-    #                 print(source_sent)
-    #                 print(record[4])
-    #                 exit(0)
-    #             path_counter['->'.join(path)] += 1
-    # pprint(path_counter.most_common(30))
-    # print()
-
-        # Extract highest-positioned counterparts from one-to-many alignments
+    # Extract highest-positioned counterparts from one-to-many alignments
+    with instr.stage('depth_resolution'):
         for node_fr, nodes_en in one_to_many_fr.items():
             minimum_depth_node_en = get_minimum_depth_node(nodes_en, en_g)
             alignment_edges.append((minimum_depth_node_en, node_fr))
@@ -255,49 +163,128 @@ if __name__ == '__main__':
             minimum_depth_node_fr = get_minimum_depth_node(nodes_fr, fr_g)
             alignment_edges.append((node_en, minimum_depth_node_fr))
         alignment_edges.sort(key = lambda x: int(x[0]))
-        
-        # Extract paths and count them 
+
+    # Extract paths and count them 
+    n_paths = 0
+    with instr.stage('paths'):
         for c in combs(alignment_edges, 2):
             p, q = c
             en1, fr1 = map(normalise_key, p)
             en2, fr2 = map(normalise_key, q)
-            if fr_n[fr1]['pos'] == 'CCONJ' or fr_n[fr2]['pos'] == 'CCONJ':
+            if fr_g[fr1]['pos'] == 'CCONJ' or fr_g[fr2]['pos'] == 'CCONJ':
                 continue # CCONJs were not aligned for Russian
-            path_en = strip_directions(get_path(en1, en2, en_g))
-            path_fr = strip_directions(get_path(fr1, fr2, fr_g))
-            # path_en = get_path(en1, en2, en_g)
-            # path_fr = get_path(fr1, fr2, fr_g)
-            if len(path_en) > 1:
+            path_en = en_g.relation_path(en1, en2)
+            n_paths += 1
+            if len(path_en) != 1:
                 continue
-            if path_en[0] not in all_single_edge_paths:
-                all_single_edge_paths.add(path_en[0])
-            path_counter[(path_en[0], '->'.join(path_fr))] += 1
-
-    path_stats = {
-        'path': [],
-        'count': [],
-        'entropy': [],
-        'prob1': [],
-        'prob2': [],
-        'prob3': [],
-        'path1': [],
-        'path2': [],
-        'path3': []
-    }
-    for p in all_single_edge_paths:
-        entropy, (prob1, prob2, prob3), (path1, path2, path3) = entropy_for_path(p, path_counter)
-        path_stats['path'].append(p)
-        path_stats['count'].append(count_for_path(p, path_counter))
-        path_stats['entropy'].append(entropy)
-        path_stats['prob1'].append(prob1)
-        path_stats['prob2'].append(prob2)
-        path_stats['prob3'].append(prob3)
-        path_stats['path1'].append(path1)
-        path_stats['path2'].append(path2)
-        path_stats['path3'].append(path3)
-
-    df = pandas.DataFrame(path_stats)
-    df.to_csv('en-ru-path-entropies-w-paths-directionless.csv', index=False)
+            path_en_id = vocab.intern(path_en)
+            all_single_edge_paths[path_en_id] = None
+            path_counter.add(path_en_id, vocab.intern(fr_g.relation_path(fr1, fr2)))
+            n_paths += 1
+    n_edges = len(alignment_edges)
+    instr.count('sentences')
+    instr.count('pairs', n_edges * (n_edges - 1) // 2)
+    instr.count('paths', n_paths)
+    instr.count('depth_lookups', len(one_to_many_en) + len(one_to_many_fr))
+
+
+def _count_paths_shard(records):
+    """Worker-side count_paths. Relation and path ids are local to the
+    process, so the vocabulary is sent back as label tuples."""
+    path_counter, vocab, single_edge_paths = count_paths(records)
+    return (
+        list(path_counter.items()),
+        [vocab.labels(i) for i in range(len(vocab))],
+        single_edge_paths
+    )
+
+
+def count_paths_parallel(records, workers):
+    """Shards the records into contiguous chunks, counts paths in a
+    process pool and merges the shards in order, so that the result,
+    including the order of keys, is the same as that of count_paths."""
+    n_shards = workers * 4
+    shard_size = -(-len(records) // n_shards) or 1
+    shards = [records[i:i+shard_size] for i in range(0, len(records), shard_size)]
+    vocab = PathVocabulary()
+    path_counter = PathPairCounter()
+    all_single_edge_paths = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for shard_counts, shard_paths, shard_single_edge_paths in executor.map(
+                _count_paths_shard, shards):
+            remap = [vocab.intern_labels(labels) for labels in shard_paths]
+            for (source_id, target_id), val in shard_counts:
+                path_counter.add(remap[source_id], remap[target_id], val)
+            for path_id in shard_single_edge_paths:
+                all_single_edge_paths[remap[path_id]] = None
+    return path_counter, vocab, list(all_single_edge_paths)
+
+
+def path_matrix(records, workers=1, en_trees=None, instr=NO_INSTRUMENTATION):
+    """Counts path pairs over verified records. Returns the
+    ContingencyMatrix of path ids and the PathVocabulary. Only the
+    serial path counting is broken down into stages by `instr`."""
+    if workers > 1:
+        with instr.stage('count_paths_parallel'):
+            path_ids, vocab, _ = count_paths_parallel(records, workers)
+    else:
+        path_ids, vocab, _ = count_paths(records, en_trees=en_trees, instr=instr)
+    return ContingencyMatrix.from_pairs(path_ids.items()), vocab
+
+
+def path_entropies(records, workers=1, en_trees=None, instr=NO_INSTRUMENTATION, matrix_path=None):
+    """Returns the table of per-path counts, entropies and top target
+    paths of verified records. With `matrix_path`, the path confusion
+    matrix is also saved there (see ContingencyMatrix.save)."""
+    matrix, vocab = path_matrix(records, workers, en_trees, instr)
+    # Strings are only needed from here on
+    with instr.stage('aggregation'):
+        if matrix_path is None:
+            return path_entropy_table(matrix, label=vocab.to_str)
+        matrix = ContingencyMatrix(
+            matrix.rows, matrix.cols, matrix.counts,
+            [vocab.to_str(p) for p in matrix.row_labels],
+            [vocab.to_str(p) for p in matrix.col_labels])
+        matrix.save(matrix_path)
+        return path_entropy_table(matrix)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('fname', nargs='?', default='pud.db')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes for path extraction')
+    parser.add_argument('--stats', metavar='FILE',
+                        help="write per-stage timings and counters as JSON ('-' for stderr)")
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write cProfile statistics of the run')
+    parser.add_argument('--matrix', metavar='FILE',
+                        help='also save the sparse path confusion matrix (.npz)')
+    args = parser.parse_args()
+    instr = Instrumentation() if args.stats else NO_INSTRUMENTATION
+    with profiled(args.profile):
+        conn = sqlite3.connect(args.fname)
+        cursor = conn.cursor()
+        with instr.stage('read'):
+            en_ru = [r for r in cursor.execute('select * from `en-ru` where `verified` = 1')]
+            print(len(en_ru))
+            en_fr = [r for r in cursor.execute('select * from `en-fr` where `verified` = 1')]
+            print(len(en_fr))
+
+        # Create French table
+        en_trees = None
+        if args.workers == 1 and cursor.execute(
+                "select 1 from sqlite_master where name = 'sentences_en'").fetchone():
+            # Normalized databases share parsed English trees between pairs
+            with instr.stage('parse_english'):
+                en_trees = get_english_trees(args.fname)
+        path_stats = path_entropies(en_ru, args.workers, en_trees, instr, args.matrix)
+
+        with instr.stage('write'):
+            df = pandas.DataFrame(path_stats)
+            df.to_csv('en-ru-path-entropies-w-paths-directionless.csv', index=False)
+    if args.stats:
+        instr.write_summary(args.stats)
 
 
 
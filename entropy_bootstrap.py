@@ -0,0 +1,294 @@
+# Bootstrap confidence intervals for syntactic entropies, as in the
+# "Syntactic entropies of original and translated sentences" notebook,
+# for all treebanks and aligned corpora in one run:
+#
+#   - the POS and edge-label entropy of every treebank, written in the
+#     format that entropy.R reads (Language, Entropy, CI_lower,
+#     CI_upper, Corpus, Type);
+#   - the entropy of the target paths of every English single-edge path
+#     (the entropy column of create_arrays.py) for every en-xx table of
+#     a database, with CI_lower and CI_upper columns added.
+#
+# Each data set is turned into a sentences x counts matrix once; a
+# bootstrap replicate is a row of resampling weights, so a chunk of
+# replicates is a single matrix product followed by grouped entropies.
+# Chunks are spread over a process pool. Every chunk has its own seed
+# derived from --seed and the data set name, so the intervals do not
+# depend on the number of workers or on the other data sets in the run.
+#
+# Usage: entropy_bootstrap.py [--treebanks FILE ...] [--db pud.db]
+#                             [--tables en-ru ...] [--iterations 1000]
+#                             [--alpha 0.05] [--method percentile|basic]
+#                             [--sample-size N] [--seed 0] [--workers N]
+#                             [--entropy-out FILE] [--paths-out FILE]
+#
+# Treebanks default to all *-ud-*.conllu files in the current directory;
+# *_pud-ud-test.conllu files are the PUD corpus, the others are native.
+# Like the notebook, intervals run from the alpha to the 1 - alpha
+# quantile of the replicates, and replicates of treebanks draw 1000
+# sentences (--sample-size; 0 draws as many sentences as there are).
+# Path replicates draw as many verified sentences as the table has.
+#
+# Paths with many rare targets have much lower entropies in resamples,
+# so their percentile intervals lie below the estimate. Path intervals
+# are therefore 'basic' by default: the quantiles are reflected around
+# the estimate, which corrects for the bias. Plug-in entropies
+# underestimate, so these intervals can lie above the plug-in estimate;
+# the paths table has an entropy_bc column with the bias-corrected
+# estimate (2 * estimate - mean of the replicates) that they surround.
+# --method forces one interval type for all data sets. Intervals that
+# exclude their plug-in estimate are counted on stderr.
+
+import os
+import sys
+import zlib
+import sqlite3
+import numpy as np
+import pandas
+
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from sys import exit
+
+from PUDAnalisysLib import ContingencyMatrix, iter_conllu
+from label_distributions import count_labels, count_matrix, language_code
+from path_stats import sentence_path_pairs
+
+LANGUAGE_NAMES = {
+    'ar': 'Arabic',
+    'cs': 'Czech',
+    'en': 'English',
+    'fr': 'French',
+    'id': 'Indonesian',
+    'ja': 'Japanese',
+    'ko': 'Korean',
+    'ru': 'Russian',
+    'zh': 'Chinese'
+}
+
+CHUNK_SIZE = 100
+
+
+class BootstrapData:
+    """Per-sentence counts of a data set. Columns of `counts` are sorted
+    by group, group i owning the columns starts[i]:starts[i+1]; the
+    entropy of a group is that of the distribution over its columns.
+    `method` is the interval type used unless bootstrap is given one."""
+
+    def __init__(self, name, counts, groups, sample_size=None, method='percentile'):
+        counts = np.asarray(counts)
+        groups = np.asarray(groups, dtype=np.int64)
+        order = np.argsort(groups, kind='stable')
+        self.name = name
+        self.counts = counts[:, order].astype(np.float64)
+        sorted_groups = groups[order]
+        self.starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        self.sample_size = sample_size or len(counts)
+        self.method = method
+
+    @property
+    def n_groups(self):
+        return len(self.starts)
+
+    def entropies(self, totals):
+        """Entropies of the groups of every row of `totals`, a (replicates
+        x columns) count array; NaN for groups without counts."""
+        sums = np.add.reduceat(totals, self.starts, axis=1)
+        weighted = totals * np.log2(totals, out=np.zeros_like(totals), where=totals > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.log2(sums) - np.add.reduceat(weighted, self.starts, axis=1) / sums
+        result[sums == 0] = np.nan
+        return result
+
+    def point_estimates(self):
+        return self.entropies(self.counts.sum(axis=0, keepdims=True))[0]
+
+    def replicates(self, n, seed):
+        """Entropies of n bootstrap replicates as an (n, groups) array."""
+        rng = np.random.default_rng(seed)
+        n_sentences = len(self.counts)
+        samples = rng.integers(n_sentences, size=(n, self.sample_size))
+        weights = np.bincount(
+            (samples + n_sentences * np.arange(n)[:, None]).ravel(),
+            minlength=n * n_sentences).reshape(n, n_sentences).astype(np.float64)
+        return self.entropies(weights @ self.counts)
+
+
+def _chunk_seed(seed, name, chunk):
+    return np.random.SeedSequence(seed, spawn_key=(zlib.crc32(name.encode('utf-8')), chunk))
+
+
+def _run_chunk(task):
+    data, n, seed = task
+    return data.replicates(n, seed)
+
+
+def bootstrap(datasets, iterations=1000, alpha=0.05, seed=0, workers=1, method=None):
+    """Returns {name: (estimates, CI_lower, CI_upper, bias-corrected
+    estimates)}, arrays with a value per group, for a list of
+    BootstrapData. Groups that are empty in some replicates get their
+    interval from the others. `method` is 'percentile' (the notebook's)
+    or 'basic', which reflects the quantiles around the estimate and so
+    corrects for the downward bias of entropies of replicates with many
+    rare outcomes; by default every data set uses its own method."""
+    tasks = [
+        (data, min(CHUNK_SIZE, iterations - start), _chunk_seed(seed, data.name, chunk))
+        for data in datasets
+        for chunk, start in enumerate(range(0, iterations, CHUNK_SIZE))]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(_run_chunk, tasks))
+    else:
+        chunks = [_run_chunk(task) for task in tasks]
+    results = {}
+    n_chunks = len(tasks) // len(datasets) if datasets else 0
+    for i, data in enumerate(datasets):
+        replicates = np.concatenate(chunks[i*n_chunks:(i+1)*n_chunks])
+        # The order statistics the notebook picks from sorted replicates
+        lower, upper = np.nanquantile(
+            replicates, [alpha, 1 - alpha], axis=0, method='inverted_cdf')
+        estimates = data.point_estimates()
+        if (method or data.method) == 'basic':
+            lower, upper = 2 * estimates - upper, 2 * estimates - lower
+        bias_corrected = 2 * estimates - np.nanmean(replicates, axis=0)
+        results[data.name] = (estimates, lower, upper, bias_corrected)
+    return results
+
+
+def treebank_dataset(path, sample_size=1000):
+    """POS (group 0) and edge-label (group 1) counts of every sentence
+    of a CoNLL-U file. Edge labels keep their subtypes."""
+    pos_counters, edge_counters = [], []
+    for _, _, block in iter_conllu(path):
+        pos_counts, edge_label_counts = count_labels(block.splitlines(), strip_subtypes=False)
+        pos_counters.append(pos_counts)
+        edge_counters.append(edge_label_counts)
+    pos_labels, pos_counts = count_matrix(pos_counters)
+    edge_labels, edge_counts = count_matrix(edge_counters)
+    return BootstrapData(
+        path, np.hstack([pos_counts, edge_counts]),
+        [0] * len(pos_labels) + [1] * len(edge_labels), sample_size)
+
+
+def path_dataset(conn, table):
+    """(English path, target path) pair counts of every verified sentence
+    of a table. Returns the BootstrapData, grouped by English path, the
+    English paths in the order create_arrays.py lists them and their
+    counts. Intervals are 'basic' by default, see above."""
+    sentences = []
+    for en, target, alignment in conn.execute(
+            f'SELECT `en`, `ru`, `alignment` FROM `{table}` WHERE `verified` = 1 ORDER BY rowid'):
+        sentences.append(sentence_path_pairs(en, target, alignment))
+    total = Counter()
+    for pairs in sentences:
+        total.update(pairs)
+    matrix = ContingencyMatrix.from_pairs(total.items())
+    index = {pair: i for i, pair in enumerate(total)}
+    counts = np.zeros((len(sentences), len(index)), dtype=np.int64)
+    for row, pairs in enumerate(sentences):
+        for pair, n in pairs.items():
+            counts[row, index[pair]] = n
+    data = BootstrapData(table, counts, matrix.rows, method='basic')
+    return data, matrix.row_labels, matrix.row_totals()
+
+
+def language_name(code):
+    return LANGUAGE_NAMES.get(code, code)
+
+
+def report_excluded_estimates(results):
+    """Prints to stderr how many intervals of each data set do not
+    contain their plug-in estimate."""
+    for name, (estimates, lower, upper, _) in results.items():
+        defined = ~np.isnan(lower)
+        outside = int(np.sum(defined & ((estimates < lower) | (estimates > upper))))
+        if outside:
+            print(f'{name}: {outside} of {int(defined.sum())} intervals exclude the plug-in estimate',
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--treebanks', nargs='*',
+                        help='CoNLL-U files (default: *-ud-*.conllu)')
+    parser.add_argument('--db', default='pud.db')
+    parser.add_argument('--tables', nargs='*',
+                        help='aligned en-xx tables (default: en-ru en-fr, where present)')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--sample-size', type=int, default=1000,
+                        help='sentences per treebank replicate (0: all)')
+    parser.add_argument('--method', choices=['percentile', 'basic'],
+                        help='interval type of all data sets (default: percentile '
+                             'for treebanks, basic for paths)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--entropy-out', default='morphosyntactic_entropy.csv')
+    parser.add_argument('--paths-out', default='path_entropy_cis.csv')
+    args = parser.parse_args()
+    if not 0 < args.alpha < 0.5:
+        exit('--alpha must be between 0 and 0.5')
+
+    treebanks = sorted(glob('*-ud-*.conllu')) if args.treebanks is None else args.treebanks
+    datasets = [treebank_dataset(path, args.sample_size) for path in treebanks]
+
+    tables = args.tables
+    paths = {}
+    if tables is None:
+        tables = []
+        if os.path.exists(args.db):
+            conn = sqlite3.connect(args.db)
+            names = {row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+            conn.close()
+            tables = [table for table in ['en-ru', 'en-fr'] if table in names]
+    if tables:
+        conn = sqlite3.connect(args.db)
+        for table in tables:
+            try:
+                data, path_labels, path_counts = path_dataset(conn, table)
+            except ValueError as e:
+                exit(f'{table}: {e}')
+            datasets.append(data)
+            paths[table] = (path_labels, path_counts)
+        conn.close()
+    if not datasets:
+        exit('Nothing to do: no treebanks or aligned tables found')
+
+    results = bootstrap(datasets, args.iterations, args.alpha, args.seed,
+                        args.workers, args.method)
+    report_excluded_estimates(results)
+
+    if treebanks:
+        rows = []
+        for path in treebanks:
+            estimates, lower, upper, _ = results[path]
+            corpus = 'PUD' if os.path.basename(path).endswith('_pud-ud-test.conllu') else 'Native'
+            for group, kind in enumerate(['POS', 'Edges']):
+                rows.append({
+                    'Language': language_name(language_code(path)),
+                    'Entropy': estimates[group],
+                    'CI_lower': lower[group],
+                    'CI_upper': upper[group],
+                    'Corpus': corpus,
+                    'Type': kind
+                })
+        pandas.DataFrame(rows).to_csv(args.entropy_out, index=False)
+        print(f'{len(treebanks)} treebanks written to {args.entropy_out}')
+    if paths:
+        frames = []
+        for table, (path_labels, path_counts) in paths.items():
+            estimates, lower, upper, bias_corrected = results[table]
+            frames.append(pandas.DataFrame({
+                'Language': language_name(table.split('-')[-1]),
+                'path': path_labels,
+                'count': path_counts,
+                'entropy': estimates,
+                'entropy_bc': bias_corrected,
+                'CI_lower': lower,
+                'CI_upper': upper
+            }))
+        pandas.concat(frames).to_csv(args.paths_out, index=False)
+        print(f'{", ".join(paths)}: paths written to {args.paths_out}')
@@ -0,0 +1,88 @@
+# Ingests all PUD treebanks against the English one in a single run.
+# English is read once; target languages are paired with it in a process
+# pool. For every language xx the script writes the `en-xx` table of
+# pud.db (with the alignments from en-xx.align if that file exists) and
+# the aligner input en-xx.pharao. Table writes happen in the main
+# process, since SQLite has a single writer anyway.
+
+import os
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import create_engine
+from sys import exit
+from time import perf_counter
+
+from PUDAnalisysLib import iter_conllu
+from populate_db import aligned_sentences, populate_table
+from prepare_pharao import pharao_path, write_pharao_input
+
+LANGUAGES = ['ar', 'cs', 'fr', 'id', 'ja', 'ru', 'zh']
+
+english = None
+
+
+def set_english(en_sentences):
+    global english
+    english = en_sentences
+
+
+def prepare_language(lang):
+    """Pairs a target treebank with English and writes the aligner
+    input. Returns (lang, rows, alignment path, seconds)."""
+    start = perf_counter()
+    target_path = f'{lang}_pud-ud-test.conllu'
+    alignment_path = f'en-{lang}.align'
+    if not os.path.exists(alignment_path):
+        alignment_path = '_'
+    rows = list(aligned_sentences(english, target_path, alignment_path))
+    with open(pharao_path(target_path), 'w') as out:
+        write_pharao_input(english, target_path, out)
+    return (lang, rows, alignment_path, perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('languages', nargs='*', default=LANGUAGES)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--upsert', action='store_true',
+                      help='update existing tables, keeping alignments of verified sentences')
+    mode.add_argument('--replace', action='store_true',
+                      help='overwrite the contents of existing tables')
+    parser.add_argument('--normalized', action='store_true', default=None,
+                        help='store English once in sentences_en and create the tables as views')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    en_sentences = list(iter_conllu('en_pud-ud-test.conllu'))
+    print(f'en: {len(en_sentences)} sentences read in {perf_counter() - start:.2f}s')
+
+    db_connect = create_engine('sqlite:///pud.db')
+    failed = []
+    with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=set_english,
+            initargs=(en_sentences,)) as executor:
+        futures = {executor.submit(prepare_language, lang): lang for lang in args.languages}
+        for future in as_completed(futures):
+            lang = futures[future]
+            try:
+                lang, rows, alignment_path, prepare_time = future.result()
+                write_start = perf_counter()
+                n = populate_table(
+                    db_connect, f'en-{lang}', rows,
+                    upsert = args.upsert, replace = args.replace,
+                    normalized = args.normalized)
+                write_time = perf_counter() - write_start
+            except (ValueError, OSError) as e:
+                print(f'{lang}: FAILED: {e}')
+                failed.append(lang)
+                continue
+            alignment_note = 'no alignments' if alignment_path == '_' else alignment_path
+            print(f'{lang}: {n} sentences ({alignment_note}), '
+                  f'prepared in {prepare_time:.2f}s, written in {write_time:.2f}s')
+    print(f'{len(args.languages) - len(failed)}/{len(args.languages)} languages '
+          f'ingested in {perf_counter() - start:.2f}s')
+    if failed:
+        exit(1)
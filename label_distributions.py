@@ -0,0 +1,138 @@
+# POS and edge-label distributions of treebanks and the divergences
+# between them, as in the "KL divergences" notebook. Each treebank is
+# read once, line by line, into a count vector; the vectors of all
+# treebanks share one label vocabulary, and the language x language KL
+# and Jensen-Shannon matrices are computed from them in one step.
+# Counts are cached per file (and recounted when the file changes), so
+# adding a treebank costs one pass over that file only.
+#
+# Usage: label_distributions.py [--out-prefix PREFIX] [treebank ...]
+#
+# Treebanks default to all *_pud-ud-test.conllu files in the current
+# directory. Writes PREFIX{pos,edges}_{kl,js}.csv (default prefix
+# 'divergences_'); row i, column j of a KL matrix is KL(i || j) in bits.
+
+import os
+import numpy as np
+import pandas
+
+from argparse import ArgumentParser
+from collections import Counter
+from glob import glob
+
+# Labels that get_counts in the notebook leaves out
+IGNORED_POS = {'X', '_', 'PUNCT'}
+IGNORED_EDGE_LABELS = {'_', 'punct', 'root'}
+
+_label_counts = {}
+
+
+def count_labels(lines, strip_subtypes=True):
+    """Returns (POS counts, edge label counts) of CoNLL-U lines. Edge
+    labels lose their subtypes (nmod:poss counts as nmod) unless
+    `strip_subtypes` is false."""
+    pos_counts = Counter()
+    edge_label_counts = Counter()
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        pos = fields[3]
+        edge = fields[7]
+        if pos not in IGNORED_POS:
+            pos_counts[pos] += 1
+        if edge not in IGNORED_EDGE_LABELS:
+            edge_label_counts[edge.split(':')[0] if strip_subtypes else edge] += 1
+    return pos_counts, edge_label_counts
+
+
+def treebank_counts(path):
+    """count_labels for a CoNLL-U file, read in a single streaming pass.
+    The result is cached until the file changes."""
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = _label_counts.get(key)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    with open(path, 'r', encoding='utf-8') as inp:
+        counts = count_labels(inp)
+    _label_counts[key] = ((stat.st_mtime_ns, stat.st_size), counts)
+    return counts
+
+
+def count_matrix(counters, labels=None):
+    """Stacks Counters into a (len(counters), len(labels)) array of
+    counts. Labels default to the sorted union of the keys."""
+    if labels is None:
+        labels = sorted(set().union(*counters))
+    index = {label: i for i, label in enumerate(labels)}
+    matrix = np.zeros((len(counters), len(labels)), dtype=np.int64)
+    for row, counter in enumerate(counters):
+        for label, n in counter.items():
+            matrix[row, index[label]] = n
+    return labels, matrix
+
+
+def _probabilities(counts):
+    counts = np.asarray(counts, dtype=np.float64)
+    totals = counts.sum(axis=1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+
+def _log2(probs):
+    return np.log2(probs, out=np.zeros_like(probs), where=probs > 0)
+
+
+def kl_matrix(counts):
+    """Pairwise KL divergences (in bits) between the rows of a count
+    matrix: entry (i, j) is KL(P_i || P_j). Like the notebook, labels
+    that only one of the two distributions has are left out of the sum
+    instead of making the divergence infinite; probabilities are not
+    renormalized over the common labels."""
+    probs = _probabilities(counts)
+    logs = _log2(probs)
+    present = (probs > 0).astype(np.float64)
+    # sum over common labels of P_i log P_i - P_i log P_j
+    return (probs * logs) @ present.T - probs @ logs.T
+
+
+def js_matrix(counts):
+    """Pairwise Jensen-Shannon divergences (in bits, between 0 and 1)
+    between the rows of a count matrix."""
+    probs = _probabilities(counts)
+    entropies = -(probs * _log2(probs)).sum(axis=1)
+    mixtures = (probs[:, None, :] + probs[None, :, :]) / 2
+    mixture_entropies = -(mixtures * _log2(mixtures)).sum(axis=2)
+    js = mixture_entropies - (entropies[:, None] + entropies[None, :]) / 2
+    return np.clip(js, 0, None)
+
+
+def language_code(path):
+    """'ru' for ru_pud-ud-test.conllu."""
+    return os.path.basename(path).split('_')[0]
+
+
+def divergence_tables(paths):
+    """Returns {name: DataFrame} with the POS and edge label KL and JS
+    matrices of the treebanks, indexed by language code."""
+    counts = [treebank_counts(path) for path in paths]
+    languages = [language_code(path) for path in paths]
+    tables = {}
+    for kind, counters in zip(['pos', 'edges'], zip(*counts)):
+        _, matrix = count_matrix(counters)
+        for measure, fn in [('kl', kl_matrix), ('js', js_matrix)]:
+            tables[f'{kind}_{measure}'] = pandas.DataFrame(
+                fn(matrix), index=languages, columns=languages)
+    return tables
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('treebanks', nargs='*')
+    parser.add_argument('--out-prefix', default='divergences_')
+    args = parser.parse_args()
+    paths = args.treebanks or sorted(glob('*_pud-ud-test.conllu'))
+    for name, table in divergence_tables(paths).items():
+        out_path = f'{args.out_prefix}{name}.csv'
+        table.to_csv(out_path)
+        print(f'{name}: {len(table)} x {len(table)} written to {out_path}')
@@ -0,0 +1,328 @@
+# Load test of the ud-app.py REST API. Seeds a temporary pud.db with
+# en-ru and en-fr from the bundled PUD treebanks and alignments (the
+# sentences that create_arrays.py can process are marked as verified),
+# then replays a mix of annotator requests from concurrent clients and
+# reports latency percentiles, throughput and lock errors per endpoint.
+#
+# Usage: loadtest.py [--concurrency N] [--requests N | --duration S]
+#                    [--mix corpora=2,getids=5,range=20,get=48,post=25]
+#                    [--server] [--normalized] [--path-stats] [--token-tables]
+#                    [--out results.json]
+#        loadtest.py --url http://host:port --db pud.db ...
+#
+# By default requests go through the Flask test client; --server starts
+# the app on a local threaded werkzeug server and goes through HTTP.
+# --url targets a server that is already running (e.g. gunicorn) on the
+# database given with --db, which is only read to pick sentences; POSTs
+# write back the alignments and verification marks that are already
+# there. Lock errors ("database is locked") are only seen in-process;
+# against --url they show up as 500s.
+
+import os
+import json
+import runpy
+import sqlite3
+import tempfile
+import http.client
+
+from argparse import ArgumentParser
+from random import Random
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sys import exit
+from threading import Lock, Thread, local
+from time import perf_counter
+from urllib.parse import urlsplit
+
+import numpy as np
+
+import path_stats
+import token_tables
+
+from benchmark import repo_file, processable
+from populate_db import aligned_sentences, populate_table
+
+TABLES = ['en-ru', 'en-fr']
+
+DEFAULT_MIX = 'corpora=2,getids=5,range=20,get=48,post=25'
+
+
+def seed_database(path, normalized=False, with_path_stats=False, with_token_tables=False):
+    """Loads the bundled corpora into a new database at `path`."""
+    db_connect = create_engine(f'sqlite:///{path}')
+    for table in TABLES:
+        lang = table.split('-')[1]
+        rows = list(aligned_sentences(
+            repo_file('en_pud-ud-test.conllu'),
+            repo_file(f'{lang}_pud-ud-test.conllu'),
+            repo_file(f'{table}.align')))
+        populate_table(db_connect, table, rows, normalized=normalized)
+        conn = sqlite3.connect(path)
+        conn.executemany(
+            f'UPDATE `{table}` SET `verified` = 1 WHERE `document_id` = ? AND `sentence_id` = ?',
+            [row[:2] for row in rows if processable((None, None) + row[2:])])
+        conn.commit()
+        conn.close()
+    with db_connect.connect() as conn:
+        with conn.begin():
+            for table in TABLES:
+                if with_token_tables:
+                    token_tables.build(conn, table)
+                if with_path_stats:
+                    path_stats.build(conn, table)
+
+
+def read_sentences(path):
+    """Returns {table: [(document_id, sentence_id, alignment, verified)]}."""
+    conn = sqlite3.connect(path)
+    sentences = {
+        table: conn.execute(
+            f'SELECT `document_id`, `sentence_id`, `alignment`, `verified` FROM `{table}` ORDER BY rowid').fetchall()
+        for table in TABLES
+    }
+    conn.close()
+    return sentences
+
+
+def parse_mix(mix):
+    kinds, weights = [], []
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in {'corpora', 'getids', 'range', 'get', 'post'}:
+            raise ValueError(f'Unknown request kind: {kind}')
+        kinds.append(kind)
+        weights.append(float(weight))
+    return kinds, weights
+
+
+def next_request(rng, kinds, weights, sentences):
+    """Returns (kind, method, url, json body) of a random request."""
+    kind = rng.choices(kinds, weights)[0]
+    table = rng.choice(TABLES)
+    if kind == 'corpora':
+        return kind, 'GET', '/corpora', None
+    if kind == 'getids':
+        return kind, 'GET', f'/getids/{table}', None
+    if kind == 'range':
+        start = rng.randrange(0, len(sentences[table]), 50)
+        return kind, 'GET', f'/range/{table}?start={start}&count=50', None
+    document_id, sentence_id, alignment, verified = rng.choice(sentences[table])
+    url = f'/{table}/{document_id}/{sentence_id}'
+    if kind == 'get':
+        return kind, 'GET', url, None
+    return kind, 'POST', url, {'alignment': alignment, 'verified': verified}
+
+
+class TestClientTransport:
+    """Sends requests through a Flask test client per thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self.clients = local()
+
+    def request(self, method, url, body):
+        client = getattr(self.clients, 'client', None)
+        if client is None:
+            client = self.clients.client = self.app.test_client()
+        response = client.open(url, method=method, json=body)
+        response.close()
+        return response.status_code
+
+
+class HTTPTransport:
+    """Sends requests over a keep-alive HTTP connection per thread."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.connections = local()
+
+    def request(self, method, url, body):
+        conn = getattr(self.connections, 'conn', None)
+        if conn is None:
+            conn = self.connections.conn = http.client.HTTPConnection(self.host, self.port)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, url, body=data, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self.connections.conn = None
+            raise
+        return response.status
+
+
+def load_app(workdir):
+    """Runs ud-app.py against workdir/pud.db and returns the Flask app
+    and a list that collects the unhandled exceptions of requests."""
+    from flask import got_request_exception
+    from werkzeug.exceptions import HTTPException
+    cwd = os.getcwd()
+    os.chdir(workdir) # ud-app.py opens pud.db in the current directory
+    try:
+        app = runpy.run_path(repo_file('ud-app.py'), run_name='ud_app')['app']
+    finally:
+        os.chdir(cwd)
+    exceptions = []
+    def record_exception(sender, exception, **extra):
+        if not isinstance(exception, HTTPException):
+            exceptions.append(exception)
+    got_request_exception.connect(record_exception, app, weak=False)
+    return app, exceptions
+
+
+def run_clients(transport, concurrency, n_requests, duration, kinds, weights, sentences, seed):
+    """Runs `concurrency` client threads until n_requests are sent or
+    `duration` seconds have passed. Returns the list of (kind, seconds,
+    status) and the wall time. Status None stands for a client error."""
+    results = []
+    results_lock = Lock()
+    counter = iter(range(n_requests)) if n_requests else None
+    counter_lock = Lock()
+    deadline = perf_counter() + duration if duration else None
+
+    def client(i):
+        rng = Random(seed + i)
+        own = []
+        while True:
+            if deadline is not None and perf_counter() > deadline:
+                break
+            if counter is not None:
+                with counter_lock:
+                    if next(counter, None) is None:
+                        break
+            kind, method, url, body = next_request(rng, kinds, weights, sentences)
+            start = perf_counter()
+            try:
+                status = transport.request(method, url, body)
+            except Exception:
+                status = None
+            own.append((kind, perf_counter() - start, status))
+        with results_lock:
+            results.extend(own)
+
+    start = perf_counter()
+    threads = [Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, perf_counter() - start
+
+
+def latency_stats(latencies, statuses, wall_time):
+    latencies = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / wall_time,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'max_ms': float(latencies.max()),
+        'client_errors': sum(1 for s in statuses if s is not None and 400 <= s < 500),
+        'server_errors': sum(1 for s in statuses if s is None or s >= 500)
+    }
+
+
+def make_report(results, wall_time, exceptions):
+    report = {
+        'wall_time': wall_time,
+        'overall': latency_stats(
+            [r[1] for r in results], [r[2] for r in results], wall_time),
+        'endpoints': {},
+        'lock_errors': sum(
+            1 for e in exceptions
+            if isinstance(e, OperationalError) and 'locked' in str(e)),
+        'other_exceptions': sorted({type(e).__name__ for e in exceptions})
+    }
+    for kind in sorted({r[0] for r in results}):
+        rows = [r for r in results if r[0] == kind]
+        report['endpoints'][kind] = latency_stats(
+            [r[1] for r in rows], [r[2] for r in rows], wall_time)
+    return report
+
+
+def print_report(report):
+    print(f'{"endpoint":10} {"requests":>9} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"4xx":>5} {"5xx":>5}')
+    for kind, stats in list(report['endpoints'].items()) + [('all', report['overall'])]:
+        print(f'{kind:10} {stats["requests"]:9} {stats["throughput"]:8.1f} '
+              f'{stats["p50_ms"]:8.2f} {stats["p95_ms"]:8.2f} {stats["p99_ms"]:8.2f} '
+              f'{stats["client_errors"]:5} {stats["server_errors"]:5}')
+    print(f'lock errors: {report["lock_errors"]}')
+    if report['other_exceptions']:
+        print(f'other exceptions: {", ".join(report["other_exceptions"])}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--duration', type=float,
+                        help='run for this many seconds instead of a number of requests')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='relative weights of request kinds')
+    parser.add_argument('--seed', type=int, default=0)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--server', action='store_true',
+                        help='serve the app locally over HTTP instead of using the test client')
+    target.add_argument('--url', help='base URL of a running server')
+    parser.add_argument('--db', help='database of the server given with --url')
+    parser.add_argument('--normalized', action='store_true',
+                        help='seed the database with the normalized layout')
+    parser.add_argument('--path-stats', action='store_true',
+                        help='keep materialized path statistics in the seeded database')
+    parser.add_argument('--token-tables', action='store_true',
+                        help='keep token tables in the seeded database')
+    parser.add_argument('--out', help='write the report as JSON')
+    args = parser.parse_args()
+    try:
+        kinds, weights = parse_mix(args.mix)
+    except ValueError as e:
+        exit(f'Invalid --mix: {e}')
+    if args.url and not args.db:
+        exit('--url needs --db to pick sentences from')
+
+    with tempfile.TemporaryDirectory(prefix='pud-loadtest-') as workdir:
+        server = None
+        exceptions = []
+        if args.url:
+            sentences = read_sentences(args.db)
+            transport = HTTPTransport(args.url)
+        else:
+            db_path = os.path.join(workdir, 'pud.db')
+            seed_database(db_path, args.normalized, args.path_stats, args.token_tables)
+            sentences = read_sentences(db_path)
+            app, exceptions = load_app(workdir)
+            if args.server:
+                from werkzeug.serving import make_server, WSGIRequestHandler
+                class QuietHandler(WSGIRequestHandler):
+                    def log_request(self, *args, **kwargs):
+                        pass
+                server = make_server('127.0.0.1', 0, app, threaded=True,
+                                     request_handler=QuietHandler)
+                Thread(target=server.serve_forever, daemon=True).start()
+                transport = HTTPTransport(f'http://127.0.0.1:{server.server_port}')
+            else:
+                transport = TestClientTransport(app)
+        try:
+            results, wall_time = run_clients(
+                transport, args.concurrency,
+                None if args.duration else args.requests, args.duration,
+                kinds, weights, sentences, args.seed)
+        finally:
+            if server is not None:
+                server.shutdown()
+    report = make_report(results, wall_time, exceptions)
+    report['settings'] = vars(args)
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(report, out, indent=2)
@@ -50,8 +50,13 @@ const parse2 = `# sent_id = n01001013
 22	по-другому	_	ADV	RB	_	20	advmod	_	SpaceAfter=No
 23	.	_	PUNCT	.	_	20	punct	_	_`
 
+// Sentences are fetched in pages of consecutive records
+// (see /range in ud-app.py); the next page is prefetched.
+const pageSize = 50;
+
 function chooseCorpus() {
   window.tableName = $('#selectCorpus').val();
+  window.pages = {};
   let request = $.get(requestURL + 'getids/' + window.tableName);
   request.done(data => {
     window.sentenceIDs = data;
@@ -63,32 +68,65 @@ function chooseCorpus() {
   });
 }
 
+function getPage(pageNum) {
+  // Returns a (possibly already resolved) request for a page of sentences.
+  if (!window.pages.hasOwnProperty(pageNum)) {
+    let request = $.getJSON(
+      requestURL + 'range/' + window.tableName, {
+        start: pageNum * pageSize,
+        count: pageSize
+      });
+    request.fail(() => { delete window.pages[pageNum]; });
+    window.pages[pageNum] = request;
+  }
+  return window.pages[pageNum];
+}
+
+function prefetchPage(pageNum) {
+  if (pageNum * pageSize < window.sentenceIDs.length)
+    getPage(pageNum);
+}
+
+function cachedSentence(index) {
+  // Returns the cached record for a sentence or null if its page
+  // has not arrived yet.
+  let page = window.pages[Math.floor(index / pageSize)];
+  if (page === undefined || page.state() !== 'resolved')
+    return null;
+  return page.responseJSON['sentences'][index % pageSize];
+}
+
 function showSentenceByNum() {
   window.nodeIDs = new Set();
   window.unaligned = new Set();
   window.sentenceNum = parseInt($('#sentenceNum').val());
   let index = window.sentenceNum-1,
-      request = $.get(
-        requestURL + 
-        tableName + '/' +
-        window.sentenceIDs[index]['document_id'] + '/' +
-        window.sentenceIDs[index]['sentence_id']);
+      pageNum = Math.floor(index / pageSize),
+      request = getPage(pageNum);
   request.done(data => {
-    byID('parse1').innerText = data[0]['en'];
-    byID('parse2').innerText = data[0]['ru'];
-    window.nodes.clear();
-    window.edges.clear();
-    addUDParse(data[0]['en'], window.nodes, window.edges, 'top');
-    addUDParse(data[0]['ru'], window.nodes, window.edges, 'bottom');
-    addAlignment(data[0]['alignment']);
-    let verifiedRadios = $('input:radio[name=verified]');
-    verifiedRadios.filter('[value=' + data[0]['verified'] + ']').prop('checked', true);
+    // Ignore pages arriving after the user has moved on
+    if (index !== window.sentenceNum-1)
+      return;
+    showSentence(data['sentences'][index % pageSize]);
+    prefetchPage(pageNum + 1);
   });
   request.fail(() => {
     alert('Failed to fetch the sentence from the server.');
   });
 }
 
+function showSentence(record) {
+  byID('parse1').innerText = record['en'];
+  byID('parse2').innerText = record['ru'];
+  window.nodes.clear();
+  window.edges.clear();
+  addUDParse(record['en'], window.nodes, window.edges, 'top');
+  addUDParse(record['ru'], window.nodes, window.edges, 'bottom');
+  addAlignment(record['alignment']);
+  let verifiedRadios = $('input:radio[name=verified]');
+  verifiedRadios.filter('[value=' + record['verified'] + ']').prop('checked', true);
+}
+
 function prevSentence() {
   if (window.sentenceNum > 1) {
     window.sentenceNum--;
@@ -229,6 +267,15 @@ function updateAlignment() {
           alignment: pharaoStr,
           verified: verified
         }));
+  request.done(() => {
+    // Keep the page cache in sync with the server
+    let record = cachedSentence(index);
+    if (record !== null) {
+      record['alignment'] = pharaoStr;
+      if (verified !== undefined)
+        record['verified'] = parseInt(verified);
+    }
+  });
   request.fail(() => {
     alert('Failed to update data on the server.');
   });
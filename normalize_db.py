@@ -0,0 +1,58 @@
+# Converts the en-xx tables of a database to the normalized layout
+# of populate_db.py: English is moved to sentences_en, each table is
+# replaced by `en-xx_target` and an `en-xx` view with the old columns.
+# Alignments, verification marks and the order of sentences are kept.
+# Usage: normalize_db.py [db] [table ...]
+
+from sqlalchemy import create_engine
+from sys import argv, exit
+
+from populate_db import (ENGLISH_TABLE, CREATE_ENGLISH_SQL, CREATE_TARGET_SQL,
+                         ID_INDEX_SQL, target_table, create_view)
+
+OLD_COLUMNS = ['document_id', 'sentence_id', 'en', 'ru', 'alignment', 'verified']
+
+
+def old_layout_tables(conn):
+    """Names of the tables that still store the English side."""
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+    return [name for name in names
+            if [row[1] for row in conn.execute(f'PRAGMA table_info(`{name}`)')] == OLD_COLUMNS]
+
+
+def normalize_table(conn, table_name):
+    """Moves one table to the normalized layout. Must be called inside
+    a transaction. Raises ValueError if the table has English sentences
+    that differ from the ones already in sentences_en."""
+    storage_name = target_table(table_name)
+    conn.execute(CREATE_ENGLISH_SQL)
+    conn.execute(f'INSERT OR IGNORE INTO `{ENGLISH_TABLE}` (`document_id`, `sentence_id`, `en`) SELECT `document_id`, `sentence_id`, `en` FROM `{table_name}` ORDER BY rowid')
+    mismatches = conn.execute(f'SELECT count(*) FROM `{table_name}` AS t JOIN `{ENGLISH_TABLE}` AS e ON e.`document_id` = t.`document_id` AND e.`sentence_id` = t.`sentence_id` WHERE e.`en` != t.`en`').scalar()
+    if mismatches:
+        raise ValueError(f'{table_name}: {mismatches} English sentences differ from {ENGLISH_TABLE}')
+    conn.execute(CREATE_TARGET_SQL.format(table=storage_name))
+    conn.execute(f'INSERT INTO `{storage_name}` (`document_id`, `sentence_id`, `ru`, `alignment`, `verified`) SELECT `document_id`, `sentence_id`, `ru`, `alignment`, `verified` FROM `{table_name}` ORDER BY rowid')
+    n = conn.execute(f'SELECT count(*) FROM `{storage_name}`').scalar()
+    conn.execute(f'DROP TABLE `{table_name}`')
+    conn.execute(ID_INDEX_SQL.format(table=storage_name))
+    create_view(conn, table_name)
+    return n
+
+
+if __name__ == '__main__':
+    fname = argv[1] if len(argv) > 1 else 'pud.db'
+    db_connect = create_engine(f'sqlite:///{fname}')
+    with db_connect.connect() as conn:
+        tables = argv[2:] or old_layout_tables(conn)
+        if not tables:
+            exit(f'No tables to normalize in {fname}')
+        try:
+            with conn.begin():
+                for table_name in tables:
+                    n = normalize_table(conn, table_name)
+                    print(f'{table_name}: {n} sentences')
+        except ValueError as e:
+            exit(str(e))
+        # Give the space taken by the English copies back
+        conn.execute('VACUUM')
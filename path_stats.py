@@ -0,0 +1,143 @@
+# Materialized path statistics. For corpora registered in
+# path_stats_corpora, the (English single-edge path, target path) pairs
+# counted by create_arrays.py are stored per sentence in
+# sentence_path_pairs and summed up in path_pair_counts. Writers replace
+# the contribution of a sentence in the same transaction as the change
+# of its alignment, so the entropy table can be read at any time
+# without going through all verified sentences again.
+# Usage: path_stats.py build <table> [db]
+#        path_stats.py show <table> [db]
+
+import pandas
+
+from collections import Counter
+from sqlalchemy import create_engine, text
+from sys import argv, exit
+
+from PUDAnalisysLib import ContingencyMatrix, path_entropy_table
+from create_arrays import count_paths
+
+# Pairs are numbered in the order create_arrays.py first counts them
+# (seq = sentence rowid << SEQ_BITS | position in the sentence), and
+# path_pair_counts keeps the smallest number of every pair, so that
+# rows and equally frequent targets come out in the same order.
+
+SEQ_BITS = 20
+
+CREATE_SQL = [
+    """CREATE TABLE IF NOT EXISTS `path_stats_corpora` ( `corpus` TEXT NOT NULL PRIMARY KEY )""",
+    """CREATE TABLE IF NOT EXISTS `sentence_path_pairs` ( `corpus` TEXT NOT NULL, `document_id` TEXT NOT NULL, `sentence_id` TEXT NOT NULL, `en_path` TEXT NOT NULL, `target_path` TEXT NOT NULL, `count` INTEGER NOT NULL, `seq` INTEGER NOT NULL, PRIMARY KEY (`corpus`, `document_id`, `sentence_id`, `en_path`, `target_path`) ) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS `sentence_path_pairs_pair_idx` ON `sentence_path_pairs` (`corpus`, `en_path`, `target_path`, `seq`)""",
+    """CREATE TABLE IF NOT EXISTS `path_pair_counts` ( `corpus` TEXT NOT NULL, `en_path` TEXT NOT NULL, `target_path` TEXT NOT NULL, `count` INTEGER NOT NULL, `first_seq` INTEGER NOT NULL, PRIMARY KEY (`corpus`, `en_path`, `target_path`) ) WITHOUT ROWID"""
+]
+
+INSERT_SENTENCE_SQL = """INSERT INTO `sentence_path_pairs` (`corpus`, `document_id`, `sentence_id`, `en_path`, `target_path`, `count`, `seq`) VALUES (:corpus, :document_id, :sentence_id, :en_path, :target_path, :count, :seq)"""
+
+ADD_COUNT_SQL = """INSERT INTO `path_pair_counts` (`corpus`, `en_path`, `target_path`, `count`, `first_seq`) VALUES (:corpus, :en_path, :target_path, :count, 0) ON CONFLICT (`corpus`, `en_path`, `target_path`) DO UPDATE SET `count` = `count` + excluded.`count`"""
+
+UPDATE_FIRST_SEQ_SQL = """UPDATE `path_pair_counts` SET `first_seq` = (SELECT min(`seq`) FROM `sentence_path_pairs` AS s WHERE s.`corpus` = :corpus AND s.`en_path` = :en_path AND s.`target_path` = :target_path) WHERE `corpus` = :corpus AND `en_path` = :en_path AND `target_path` = :target_path"""
+
+
+def sentence_rows(corpus, document_id, sentence_id, position, pairs):
+    return [
+        {'corpus': corpus, 'document_id': document_id, 'sentence_id': sentence_id,
+         'en_path': en_path, 'target_path': target_path, 'count': n,
+         'seq': (position << SEQ_BITS) | i}
+        for i, ((en_path, target_path), n) in enumerate(pairs.items())]
+
+
+def sentence_path_pairs(en, target, alignment):
+    """Returns a Counter of (English path, target path) strings that a
+    verified sentence contributes. Raises ValueError if the sentence
+    cannot be processed."""
+    try:
+        counter, vocab, _ = count_paths([(None, None, en, target, alignment)])
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f'Cannot extract paths from the alignment: {e!r}')
+    return counter.to_counter(vocab)
+
+
+def enabled(conn, corpus):
+    if conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'path_stats_corpora'")).fetchone() is None:
+        return False
+    return conn.execute(
+        text('SELECT 1 FROM `path_stats_corpora` WHERE `corpus` = :corpus'),
+        corpus=corpus).fetchone() is not None
+
+
+def build(conn, corpus):
+    """(Re)computes the statistics of a corpus from its verified
+    sentences and registers it for incremental updates. Must be called
+    inside a transaction. Returns the number of sentences processed."""
+    for stmt in CREATE_SQL:
+        conn.execute(stmt)
+    conn.execute(text('INSERT OR IGNORE INTO `path_stats_corpora` (`corpus`) VALUES (:corpus)'), corpus=corpus)
+    conn.execute(text('DELETE FROM `sentence_path_pairs` WHERE `corpus` = :corpus'), corpus=corpus)
+    conn.execute(text('DELETE FROM `path_pair_counts` WHERE `corpus` = :corpus'), corpus=corpus)
+    rows = conn.execute(
+        f'SELECT rowid, `document_id`, `sentence_id`, `en`, `ru`, `alignment` FROM `{corpus}` WHERE `verified` = 1 ORDER BY rowid').fetchall()
+    insert = text(INSERT_SENTENCE_SQL)
+    for position, document_id, sentence_id, en, target, alignment in rows:
+        try:
+            pairs = sentence_path_pairs(en, target, alignment)
+        except ValueError as e:
+            raise ValueError(f'{document_id}/{sentence_id}: {e}')
+        if pairs:
+            conn.execute(insert, sentence_rows(corpus, document_id, sentence_id, position, pairs))
+    conn.execute(text('INSERT INTO `path_pair_counts` (`corpus`, `en_path`, `target_path`, `count`, `first_seq`) SELECT `corpus`, `en_path`, `target_path`, sum(`count`), min(`seq`) FROM `sentence_path_pairs` WHERE `corpus` = :corpus GROUP BY `en_path`, `target_path`'), corpus=corpus)
+    return len(rows)
+
+
+def replace_sentence(conn, corpus, document_id, sentence_id, position, pairs):
+    """Replaces the contribution of a sentence (its rowid is `position`)
+    with `pairs`, a Counter from sentence_path_pairs, empty for
+    unverified sentences. Must be called in the transaction that changes
+    the sentence."""
+    ids = {'corpus': corpus, 'document_id': document_id, 'sentence_id': sentence_id}
+    old = conn.execute(text('SELECT `en_path`, `target_path`, `count` FROM `sentence_path_pairs` WHERE `corpus` = :corpus AND `document_id` = :document_id AND `sentence_id` = :sentence_id'), **ids).fetchall()
+    if not old and not pairs:
+        return
+    delta = Counter(pairs)
+    for en_path, target_path, n in old:
+        delta[(en_path, target_path)] -= n
+    if old:
+        conn.execute(text('DELETE FROM `sentence_path_pairs` WHERE `corpus` = :corpus AND `document_id` = :document_id AND `sentence_id` = :sentence_id'), **ids)
+    if pairs:
+        conn.execute(text(INSERT_SENTENCE_SQL), sentence_rows(corpus, document_id, sentence_id, position, pairs))
+    # Pairs with an unchanged count may still have moved within the sentence
+    touched = [
+        {'corpus': corpus, 'en_path': en_path, 'target_path': target_path, 'count': n}
+        for (en_path, target_path), n in delta.items()]
+    conn.execute(text(ADD_COUNT_SQL), touched)
+    if any(change['count'] < 0 for change in touched):
+        conn.execute(text('DELETE FROM `path_pair_counts` WHERE `corpus` = :corpus AND `count` <= 0'), corpus=corpus)
+    conn.execute(text(UPDATE_FIRST_SEQ_SQL), touched)
+
+
+def entropy_table(conn, corpus, k=3):
+    """Returns the table written by create_arrays.py (path, count,
+    entropy, prob1..k, path1..k) computed from the stored counts."""
+    pairs = conn.execute(text('SELECT `en_path`, `target_path`, `count` FROM `path_pair_counts` WHERE `corpus` = :corpus ORDER BY `first_seq`'), corpus=corpus)
+    matrix = ContingencyMatrix.from_pairs(
+        ((en_path, target_path), n) for en_path, target_path, n in pairs)
+    return path_entropy_table(matrix, k=k)
+
+
+if __name__ == '__main__':
+    if len(argv) < 3 or argv[1] not in {'build', 'show'}:
+        exit('Usage: path_stats.py build|show <table> [db]')
+    command, corpus = argv[1], argv[2]
+    fname = argv[3] if len(argv) > 3 else 'pud.db'
+    db_connect = create_engine(f'sqlite:///{fname}')
+    with db_connect.connect() as conn:
+        if command == 'build':
+            try:
+                with conn.begin():
+                    n = build(conn, corpus)
+            except ValueError as e:
+                exit(f'{corpus}: {e}')
+            print(f'{corpus}: path statistics of {n} verified sentences stored')
+        else:
+            if not enabled(conn, corpus):
+                exit(f'No path statistics for {corpus}; run path_stats.py build {corpus}')
+            print(pandas.DataFrame(entropy_table(conn, corpus)).to_csv(index=False), end='')
@@ -1,89 +1,300 @@
 # Accepts a conllu file, a pharao alignment, and a table name
-# as arguments.
-
-from sqlalchemy import create_engine, Table, MetaData, select, insert
-from sys import argv
-
-def fill_dict(chunks, chunk_dict):
-    cur_doc_id = ''    
-    for c in chunks:
-        lines = c.splitlines()
-        sent_id = ''
-        for l in lines:
-            if l.startswith('# newdoc id') or l.startswith('# newdoc_id'):
-                cur_doc_id = l.split(' = ')[1]
-            elif l.startswith('# sent_id'):
-                sent_id = l.split(' = ')[1]
-                break
-        if not cur_doc_id and sent_id:
-            print(c)
-            break
-        chunk_dict[(cur_doc_id, sent_id)] = c
-
-        
-def fill_alignment_dict(chunks, alignment_lines, alignment_dict):
-    """Assumes that alignments go in the same order as the chunks
-    in the source-language corpus."""
-    cur_doc_id = ''    
-    for i,c in enumerate(chunks):
-        lines = c.splitlines()
-        sent_id = ''
-        for l in lines:
-            if l.startswith('# newdoc id') or l.startswith('# newdoc_id'):
-                cur_doc_id = l.split(' = ')[1]
-            elif l.startswith('# sent_id'):
-                sent_id = l.split(' = ')[1]
-                break
-        if not cur_doc_id and sent_id:
-            print(c)
-            break
-        alignment_dict[(cur_doc_id, sent_id)] = alignment_lines[i]
-
-
-db_connect = create_engine('sqlite:///pud.db')
-
-# Source language data
-with open('en_pud-ud-test.conllu', 'r') as inp:
-    en_chunks = inp.read().strip().split('\n\n')
-
-# Target language data
-with open(argv[1], 'r') as inp:
-    ru_chunks = inp.read().strip().split('\n\n')
-
-# Alignment data
-if argv[2] == '_':
-    alignment_lines = ['' for el in ru_chunks]
-else:
-    with open(argv[2], 'r') as inp:
-        alignment_lines = inp.read().strip().splitlines()
-
-assert(len(en_chunks) == len(ru_chunks) == len(alignment_lines))
-
-en_dict = {}
-ru_dict = {}
-alignment_dict = {}
-
-fill_dict(en_chunks, en_dict)
-fill_dict(ru_chunks, ru_dict)
-fill_alignment_dict(en_chunks, alignment_lines, alignment_dict)
-
-for key in en_dict:
-    if key not in ru_dict:
-        raise ValueError('Non-aligned sentence ids')
-    
-with db_connect.connect() as conn:
-    conn.execute(f"""CREATE TABLE `{argv[3]}` ( `document_id` TEXT NOT NULL, `sentence_id` TEXT NOT NULL, `en` TEXT NOT NULL, `ru` TEXT NOT NULL, `alignment` TEXT NOT NULL DEFAULT '', `verified` INTEGER NOT NULL DEFAULT 0 )""")
-    meta = MetaData()
-    meta.reflect(bind=db_connect)   
-    pud_table = Table(argv[3], meta, autoload=True)
-    conn.execute(pud_table.delete())
-    for key in en_dict:
-        stmt = pud_table.insert().values(
-            document_id = key[0],
-            sentence_id = key[1],
-            en = en_dict[key],
-            ru = ru_dict[key],
-            alignment = alignment_dict[key],
-            verified = 0
-            )
-        conn.execute(stmt)
+# as arguments. An existing table is only touched with --upsert
+# (keeps verified alignments) or --replace. With --normalized (the
+# default once the database has a sentences_en table) English is
+# stored once in sentences_en and the table becomes a view over it.
+
+from argparse import ArgumentParser
+from itertools import zip_longest
+from sqlalchemy import create_engine, text
+from sys import exit
+
+import path_stats
+import token_tables
+
+from PUDAnalisysLib import iter_conllu
+
+
+def read_alignment_lines(path):
+    """Returns the lines of an alignment file. A blank line inside the
+    file is the empty alignment of a sentence without links; only
+    trailing blank lines are dropped."""
+    with open(path, 'r') as inp:
+        lines = [line.strip() for line in inp]
+    while lines and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def alignment_positions(en_sentences):
+    """Maps (document_id, sentence_id) to the line of the sentence in
+    alignment files, which list sentences sorted by these ids (the order
+    in which prepare_pharao.py writes the aligner input)."""
+    keys = sorted((doc_id, sent_id) for doc_id, sent_id, _ in en_sentences)
+    positions = {key: i for i, key in enumerate(keys)}
+    if len(positions) != len(keys):
+        raise ValueError('Duplicate sentence ids in the source-language corpus')
+    return positions
+
+
+def aligned_sentences(en_source, target_path, alignment_path):
+    """Streams (document_id, sentence_id, en, target, alignment) tuples in
+    corpus order. Assumes that the target corpus goes in the same order
+    as the source-language corpus; alignment lines are looked up by
+    their position in sorted id order (see alignment_positions).
+    Document ids are taken from the source side, so target treebanks
+    without '# newdoc id' comments are fine. en_source is a path, which
+    is read twice, or already read iter_conllu tuples. An alignment path
+    of '_' stands for no alignments."""
+    if isinstance(en_source, str):
+        positions = alignment_positions(iter_conllu(en_source))
+        en_sentences = iter_conllu(en_source)
+    else:
+        en_source = list(en_source)
+        positions = alignment_positions(en_source)
+        en_sentences = iter(en_source)
+    if alignment_path == '_':
+        alignments = [''] * len(positions)
+    else:
+        alignments = read_alignment_lines(alignment_path)
+        if len(alignments) < len(positions):
+            raise ValueError('Fewer alignment lines than sentences')
+        if len(alignments) > len(positions):
+            raise ValueError('More alignment lines than sentences')
+    target_sentences = iter_conllu(target_path)
+    for en_sent, target_sent in zip_longest(en_sentences, target_sentences):
+        if en_sent is None or target_sent is None:
+            raise ValueError('Different numbers of sentences in the corpora')
+        doc_id, sent_id, en = en_sent
+        _, target_sent_id, target = target_sent
+        if sent_id != target_sent_id:
+            raise ValueError(f'Non-aligned sentence ids: {sent_id}, {target_sent_id}')
+        yield (doc_id, sent_id, en, target, alignments[positions[(doc_id, sent_id)]])
+
+
+# Rows are inserted in batches with executemany inside a single
+# transaction; the (document_id, sentence_id) index is built after a
+# fresh load. Upserts keep alignments of verified sentences.
+
+BATCH_SIZE = 1000
+
+CREATE_TABLE_SQL = """CREATE TABLE IF NOT EXISTS `{table}` ( `document_id` TEXT NOT NULL, `sentence_id` TEXT NOT NULL, `en` TEXT NOT NULL, `ru` TEXT NOT NULL, `alignment` TEXT NOT NULL DEFAULT '', `verified` INTEGER NOT NULL DEFAULT 0 )"""
+
+ID_INDEX_SQL = """CREATE UNIQUE INDEX IF NOT EXISTS `{table}_document_sentence_idx` ON `{table}` (`document_id`, `sentence_id`)"""
+
+INSERT_SQL = """INSERT INTO `{table}` (`document_id`, `sentence_id`, `en`, `ru`, `alignment`, `verified`) VALUES (:document_id, :sentence_id, :en, :ru, :alignment, 0)"""
+
+UPSERT_SQL = INSERT_SQL + """ ON CONFLICT (`document_id`, `sentence_id`) DO UPDATE SET `en` = excluded.`en`, `ru` = excluded.`ru`, `alignment` = CASE WHEN `verified` = 1 THEN `alignment` ELSE excluded.`alignment` END"""
+
+
+# Normalized layout: English sentences are stored once in sentences_en,
+# `{table}_target` holds the target side and the alignment, and the
+# view `{table}` joins them back into the columns of the old table, so
+# that readers do not have to change. The view is updatable through an
+# INSTEAD OF trigger, but writers that need row counts should update
+# `{table}_target` directly.
+
+ENGLISH_TABLE = 'sentences_en'
+
+TARGET_SUFFIX = '_target'
+
+CREATE_ENGLISH_SQL = f"""CREATE TABLE IF NOT EXISTS `{ENGLISH_TABLE}` ( `document_id` TEXT NOT NULL, `sentence_id` TEXT NOT NULL, `en` TEXT NOT NULL, PRIMARY KEY (`document_id`, `sentence_id`) )"""
+
+# The English side is shared by all en-xx tables, and their alignments
+# index its tokens, so a stored sentence is never overwritten
+INSERT_ENGLISH_SQL = f"""INSERT INTO `{ENGLISH_TABLE}` (`document_id`, `sentence_id`, `en`) VALUES (:document_id, :sentence_id, :en) ON CONFLICT (`document_id`, `sentence_id`) DO NOTHING"""
+
+SELECT_ENGLISH_SQL = f"""SELECT `en` FROM `{ENGLISH_TABLE}` WHERE `document_id` = :document_id AND `sentence_id` = :sentence_id"""
+
+CREATE_TARGET_SQL = """CREATE TABLE IF NOT EXISTS `{table}` ( `document_id` TEXT NOT NULL, `sentence_id` TEXT NOT NULL, `ru` TEXT NOT NULL, `alignment` TEXT NOT NULL DEFAULT '', `verified` INTEGER NOT NULL DEFAULT 0 )"""
+
+INSERT_TARGET_SQL = """INSERT INTO `{table}` (`document_id`, `sentence_id`, `ru`, `alignment`, `verified`) VALUES (:document_id, :sentence_id, :ru, :alignment, 0)"""
+
+UPSERT_TARGET_SQL = INSERT_TARGET_SQL + """ ON CONFLICT (`document_id`, `sentence_id`) DO UPDATE SET `ru` = excluded.`ru`, `alignment` = CASE WHEN `verified` = 1 THEN `alignment` ELSE excluded.`alignment` END"""
+
+# rowid is exposed so that ordering by insertion order keeps working
+CREATE_VIEW_SQL = f"""CREATE VIEW IF NOT EXISTS `{{view}}` AS SELECT t.`document_id` AS `document_id`, t.`sentence_id` AS `sentence_id`, e.`en` AS `en`, t.`ru` AS `ru`, t.`alignment` AS `alignment`, t.`verified` AS `verified`, t.rowid AS `rowid` FROM `{{table}}` AS t JOIN `{ENGLISH_TABLE}` AS e ON e.`document_id` = t.`document_id` AND e.`sentence_id` = t.`sentence_id`"""
+
+CREATE_VIEW_TRIGGER_SQL = """CREATE TRIGGER IF NOT EXISTS `{view}_update` INSTEAD OF UPDATE OF `alignment`, `verified` ON `{view}` BEGIN UPDATE `{table}` SET `alignment` = NEW.`alignment`, `verified` = NEW.`verified` WHERE rowid = OLD.rowid; END"""
+
+
+def target_table(table_name):
+    return table_name + TARGET_SUFFIX
+
+
+def is_normalized(conn, table_name):
+    """True if table_name is a view over sentences_en and a target table."""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?",
+        (table_name,)).fetchone() is not None \
+        and table_exists(conn, target_table(table_name))
+
+
+def create_view(conn, table_name):
+    """Creates the compatibility view for a normalized table."""
+    conn.execute(CREATE_VIEW_SQL.format(
+        view=table_name, table=target_table(table_name)))
+    conn.execute(CREATE_VIEW_TRIGGER_SQL.format(
+        view=table_name, table=target_table(table_name)))
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def table_exists(conn, table_name):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table_name,)).fetchone() is not None
+
+
+def load_sentences(conn, table_name, sentences, upsert=False):
+    """Writes (document_id, sentence_id, en, ru, alignment) tuples to a
+    table in batches. Must be called inside a transaction. With
+    upsert=True existing sentences are updated in place, except that
+    alignments of verified sentences are kept. Returns the number of
+    sentences written."""
+    stmt = text((UPSERT_SQL if upsert else INSERT_SQL).format(table=table_name))
+    keys = ('document_id', 'sentence_id', 'en', 'ru', 'alignment')
+    n = 0
+    for batch in batches(sentences, BATCH_SIZE):
+        conn.execute(stmt, [dict(zip(keys, row)) for row in batch])
+        n += len(batch)
+    return n
+
+
+def load_normalized_sentences(conn, table_name, sentences, upsert=False):
+    """Like load_sentences, but writes English to sentences_en and the
+    rest to the target table of table_name. English sentences that are
+    already in sentences_en are kept; raises ValueError if they differ
+    from the new ones, as normalize_db.py does."""
+    english_stmt = text(INSERT_ENGLISH_SQL)
+    select_stmt = text(SELECT_ENGLISH_SQL)
+    target_stmt = text((UPSERT_TARGET_SQL if upsert else INSERT_TARGET_SQL).format(
+        table=target_table(table_name)))
+    n = 0
+    mismatches = 0
+    for batch in batches(sentences, BATCH_SIZE):
+        english = [
+            {'document_id': doc_id, 'sentence_id': sent_id, 'en': en}
+            for doc_id, sent_id, en, _, _ in batch]
+        conn.execute(english_stmt, english)
+        for row in english:
+            if conn.execute(select_stmt, row).scalar() != row['en']:
+                mismatches += 1
+        conn.execute(target_stmt, [
+            {'document_id': doc_id, 'sentence_id': sent_id, 'ru': ru, 'alignment': alignment}
+            for doc_id, sent_id, _, ru, alignment in batch])
+        n += len(batch)
+    if mismatches:
+        raise ValueError(f'{table_name}: {mismatches} English sentences differ from {ENGLISH_TABLE}')
+    return n
+
+
+def refresh_derived_tables(conn, table_name):
+    """Recomputes the token tables (see token_tables.py) and materialized
+    path statistics (see path_stats.py) of the table if they are kept."""
+    if token_tables.enabled(conn):
+        token_tables.build(conn, table_name)
+    if path_stats.enabled(conn, table_name):
+        path_stats.build(conn, table_name)
+
+
+def populate_table(db_connect, table_name, sentences, upsert=False, replace=False,
+                   normalized=None):
+    """Creates the table if needed and loads the sentences in a single
+    transaction with relaxed durability settings. normalized=None uses
+    the normalized layout if the database already has sentences_en."""
+    with db_connect.connect() as conn:
+        # The load is a single transaction that can simply be rerun,
+        # so there is no need to wait for fsync on the way. The
+        # connection goes back to the pool afterwards, so the previous
+        # settings are restored for its next user.
+        synchronous = conn.execute('PRAGMA synchronous').scalar()
+        temp_store = conn.execute('PRAGMA temp_store').scalar()
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        try:
+            return _populate(conn, table_name, sentences, upsert, replace, normalized)
+        finally:
+            conn.execute(f'PRAGMA synchronous={synchronous}')
+            conn.execute(f'PRAGMA temp_store={temp_store}')
+
+
+def _populate(conn, table_name, sentences, upsert, replace, normalized):
+    """populate_table on an open connection."""
+    if normalized is None:
+        normalized = table_exists(conn, ENGLISH_TABLE)
+    if normalized:
+        if table_exists(conn, table_name):
+            raise ValueError(f'Table {table_name} uses the old layout; run normalize_db.py first')
+        storage_name = target_table(table_name)
+    else:
+        if is_normalized(conn, table_name):
+            raise ValueError(f'{table_name} is a normalized table; load it with --normalized')
+        storage_name = table_name
+    if table_exists(conn, storage_name) and not (upsert or replace):
+        has_rows = conn.execute(f'SELECT 1 FROM `{storage_name}` LIMIT 1').fetchone()
+        if has_rows:
+            raise ValueError(f'Table {table_name} already exists; use --upsert to update it keeping verified alignments or --replace to overwrite it')
+    if normalized:
+        with conn.begin():
+            conn.execute(CREATE_ENGLISH_SQL)
+            conn.execute(CREATE_TARGET_SQL.format(table=storage_name))
+            if upsert:
+                conn.execute(ID_INDEX_SQL.format(table=storage_name))
+            else:
+                conn.execute(f'DROP INDEX IF EXISTS `{storage_name}_document_sentence_idx`')
+                conn.execute(f'DELETE FROM `{storage_name}`')
+            n = load_normalized_sentences(conn, table_name, sentences, upsert)
+            conn.execute(ID_INDEX_SQL.format(table=storage_name))
+            create_view(conn, table_name)
+            refresh_derived_tables(conn, table_name)
+        return n
+    with conn.begin():
+        conn.execute(CREATE_TABLE_SQL.format(table=table_name))
+        if upsert:
+            # ON CONFLICT needs the unique index to be there already
+            conn.execute(ID_INDEX_SQL.format(table=table_name))
+        else:
+            conn.execute(f'DROP INDEX IF EXISTS `{table_name}_document_sentence_idx`')
+            conn.execute(f'DELETE FROM `{table_name}`')
+        n = load_sentences(conn, table_name, sentences, upsert)
+        conn.execute(ID_INDEX_SQL.format(table=table_name))
+        refresh_derived_tables(conn, table_name)
+    return n
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('conllu', help='target-language CoNLL-U file')
+    parser.add_argument('alignment', help="pharao alignment file or _ for no alignment")
+    parser.add_argument('table')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--upsert', action='store_true',
+                      help='update an existing table, keeping alignments of verified sentences')
+    mode.add_argument('--replace', action='store_true',
+                      help='overwrite the contents of an existing table')
+    parser.add_argument('--normalized', action='store_true', default=None,
+                        help='store English once in sentences_en and create the table as a view')
+    args = parser.parse_args()
+
+    db_connect = create_engine('sqlite:///pud.db')
+    try:
+        n = populate_table(
+            db_connect,
+            args.table,
+            aligned_sentences('en_pud-ud-test.conllu', args.conllu, args.alignment),
+            upsert = args.upsert,
+            replace = args.replace,
+            normalized = args.normalized)
+    except ValueError as e:
+        exit(str(e))
+    print(f'{n} sentences written to {args.table}')
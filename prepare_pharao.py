@@ -1,48 +1,61 @@
-def fill_dict(chunks, chunk_dict):
-    cur_doc_id = ''    
-    for c in chunks:
-        lines = c.splitlines()
-        sent_id = ''
-        for l in lines:
-            if l.startswith('# newdoc id') or l.startswith('# newdoc_id'):
-                cur_doc_id = l.split(' = ')[1]
-            elif l.startswith('# sent_id'):
-                sent_id = l.split(' = ')[1]
-                break
-        if not cur_doc_id and sent_id:
-            print(c)
-            break
-        chunk_dict[(cur_doc_id, sent_id)] = c
+import os
+
+from itertools import zip_longest
+from sys import argv
+from tempfile import TemporaryFile
+
+from PUDAnalisysLib import iter_conllu
+
 
 def extract_tokens(chunk):
     lines = chunk.splitlines()
     lines = [l for l in lines if not l.startswith('#')]
     return [line.split('\t')[1] for line in lines]
 
-# Source language data
-with open('en_pud-ud-test.conllu', 'r') as inp:
-    en_chunks = inp.read().strip().split('\n\n')
-
-# Target language data
-with open('fr_pud-ud-test.conllu', 'r') as inp:
-    tg_chunks = inp.read().strip().split('\n\n')
-
-assert(len(en_chunks) == len(tg_chunks))
-
-en_dict = {}
-tg_dict = {}
-
-fill_dict(en_chunks, en_dict)
-fill_dict(tg_chunks, tg_dict)
-
-for key in en_dict:
-    if key not in tg_dict:
-        raise ValueError('Non-aligned sentence ids')
-
-ks = sorted(en_dict.keys())
 
-with open('en-fr.align', 'w') as out:
-    for k in ks:
-        en_toks = ' '.join(extract_tokens(en_dict[k])).lower()
-        tg_toks = ' '.join(extract_tokens(tg_dict[k])).lower()
-        print(f"{en_toks} ||| {tg_toks}", file = out)
+def pharao_path(tg_path):
+    """'en-fr.pharao' for fr_pud-ud-test.conllu. The aligner input is
+    never written to an en-xx.align file, which holds the checked
+    alignments."""
+    return f"en-{os.path.basename(tg_path).split('_')[0]}.pharao"
+
+
+def write_pharao_input(en_source, tg_path, out):
+    """Streams both corpora sentence by sentence and writes
+    `source ||| target` lines sorted by (document_id, sentence_id), the
+    order of the bundled alignment files, in which populate_db.py reads
+    the resulting alignments back. Lines go to a temporary file first;
+    only their ids and offsets are kept in memory for sorting, and the
+    lines are then copied to `out` in sorted order. Document ids are
+    taken from the English side. en_source is a path or already read
+    iter_conllu tuples."""
+    if isinstance(en_source, str):
+        en_sentences = iter_conllu(en_source)
+    else:
+        en_sentences = iter(en_source)
+    tg_sentences = iter_conllu(tg_path)
+    offsets = []
+    with TemporaryFile() as buffer:
+        for en_sent, tg_sent in zip_longest(en_sentences, tg_sentences):
+            if en_sent is None or tg_sent is None:
+                raise ValueError('Different numbers of sentences in the corpora')
+            en_doc_id, en_sent_id, en_chunk = en_sent
+            _, tg_sent_id, tg_chunk = tg_sent
+            if en_sent_id != tg_sent_id:
+                raise ValueError('Non-aligned sentence ids')
+            en_toks = ' '.join(extract_tokens(en_chunk)).lower()
+            tg_toks = ' '.join(extract_tokens(tg_chunk)).lower()
+            offsets.append(((en_doc_id, en_sent_id), buffer.tell()))
+            buffer.write(f"{en_toks} ||| {tg_toks}\n".encode('utf-8'))
+        offsets.sort()
+        for _, offset in offsets:
+            buffer.seek(offset)
+            out.write(buffer.readline().decode('utf-8'))
+    return len(offsets)
+
+if __name__ == '__main__':
+    # prepare_pharao.py [target.conllu [output]]
+    tg_path = argv[1] if len(argv) > 1 else 'fr_pud-ud-test.conllu'
+    out_path = argv[2] if len(argv) > 2 else pharao_path(tg_path)
+    with open(out_path, 'w') as out:
+        write_pharao_input('en_pud-ud-test.conllu', tg_path, out)
@@ -1,10 +1,18 @@
+import os
+import json
 import sqlite3
+import hashlib
+import numpy as np
 
+from argparse import ArgumentParser
+from array import array
 from itertools import combinations as combs
-from queue import SimpleQueue
 from collections import Counter
 from pprint import pprint
-from sys import argv
+from sys import stderr, stdout
+
+from PUDAnalisysLib import (conll2tree, PathVocabulary, Instrumentation,
+                            NO_INSTRUMENTATION, profiled)
 
 fname = 'pud.db'
 conn = sqlite3.connect(fname)
@@ -12,74 +20,11 @@ cursor = conn.cursor()
 
 # Graph-processging routines
 
-def conll2graph(record):
-    """Converts sentences described using CoNLL-U format 
-    (http://universaldependencies.org/format.html) to graphs. 
-    Returns a dictionary of nodes (wordforms and POS tags indexed 
-    by line numbers) together with a graph of the dependencies encoded 
-    as adjacency lists of (node_key, relation_label, direction[up or down]) tuples."""
-    graph = {}
-    nodes = {}
-    for line in record.splitlines():
-        if line.startswith('#'):
-            continue
-        fields = line.strip('\n').split('\t')
-        key = fields[0]
-        # Ignore compound surface keys for aux, du, etc.
-        # Ignore hidden additional nodes for orphan handling
-        if '-' in key or '.' in key:
-            continue
-        wordform = fields[1] 
-        pos = fields[3]
-        parent = fields[6]
-        relation = fields[7]
-        nodes[key] = { 'wordform': wordform, 'pos': pos }
-        if key not in graph:
-            graph[key] = []
-        if parent not in graph:
-            graph[parent] = []
-        graph[key].append((parent, relation, 'up'))
-        graph[parent].append((key, relation, 'down'))
-    return (nodes, graph)
-
-
 def strip_directions(path):
     """Returns a directionless path with only PUDtags as labels."""
     return list(map(lambda x: x.split('_')[0], path))
 
 
-def get_path(node1, node2, graph):
-    if node1 == node2:
-        return []
-    
-    # BFS with edge labels for paths
-    q = SimpleQueue()
-    # Remembers where we came from and the edge label
-    sources = {}
-    
-    q.put(node1)
-    visited = set()
-    visited.add(node1)
-    
-    while not q.empty():
-        current = q.get()
-        for neighbour, relation, direction in graph[current]:
-            if neighbour == node2:
-                path = [relation+'_'+direction]
-                source = current
-                while source != node1:
-                    prev_node, prev_relation, prev_direction = sources[source]
-                    path.append(prev_relation+'_'+prev_direction)
-                    source = prev_node
-                return list(reversed(path))
-            elif neighbour not in visited:
-                sources[neighbour] = (current, relation, direction)
-                q.put(neighbour)
-            visited.add(neighbour)
-            
-    raise ValueError("UD graph is not connected.")
-
-
 # More helper routines
 
 
@@ -148,121 +93,368 @@ def extract_raw_sentences(conll):
         raise ValueError('No target sentence found')
 
 
-def get_edge_label_report(corpus, path_str):
-    # Iterate over aligned records in the db
-    # From each record extract all edges with
-    # corresponding edge labels and their
-    # counterparts with marked-up examples.
-    # Classify by counterparts and return in the
-    # of decreasing group sizes.
-    result = []
-    temp_dict = {}
-    for i, record in enumerate(cursor.execute(f'select `en`,`ru`,`alignment` from `{corpus}` where verified = 1')):
-        en, ru, alignment = record
-        en_n, en_g = conll2graph(en)
-        ru_n, ru_g = conll2graph(ru)
-        alignment_dict = {}
-        (
-            unaligned_en,
-            _,
-            one_to_many_en,
-            one_to_many_ru,
-            resulting_edges
-        ) = preprocess_alignment(alignment)
-        for edge in resulting_edges:
-            head, tail = edge
+def prepare_record(en, ru, alignment):
+    """Parses both sides of a record and indexes its alignment:
+    English nodes are mapped to their Russian counterparts, one-to-many
+    English nodes are set aside, and many-to-one alignments are kept."""
+    en_g = conll2tree(en)
+    ru_g = conll2tree(ru)
+    alignment_dict = {}
+    (
+        unaligned_en,
+        _,
+        one_to_many_en,
+        one_to_many_ru,
+        resulting_edges
+    ) = preprocess_alignment(alignment)
+    for edge in resulting_edges:
+        head, tail = edge
+        alignment_dict[head] = tail
+    for tail, en_node_set in one_to_many_ru.items():
+        for head in en_node_set:
             alignment_dict[head] = tail
-        for tail, en_node_set in one_to_many_ru.items():
-            for head in en_node_set:
-                alignment_dict[head] = tail
-        accounted_for = set.union(set(alignment_dict), unaligned_en)
-        # Ignore one-to-many, but record unaligned and many-to-one
-        for pair in combs(en_n, 2):
-            en_head, en_tail = pair
-            path_en = '->'.join(
-                strip_directions(
-                    get_path(
-                        en_head, en_tail, en_g)))
-            if path_en != path_str:
-                continue
-            elif en_head in one_to_many_en or en_tail in one_to_many_en:
-                continue
-            elif en_head in unaligned_en and en_tail in unaligned_en:
-                key = 'Both endpoints unaligned'
-                ru_head = ru_tail = ''
-            elif en_head not in accounted_for or en_tail not in accounted_for:
-                # Some asemantical stuff like pseudo-amod
-                # or possibly an error
-                print(
-                    'Something is missing from the alignment dict', 
-                    i+1, 
-                    f'{en_head} ({en_n[en_head]["wordform"]})', 
-                    f'{en_tail} ({en_n[en_tail]["wordform"]})'
-                )
+    accounted_for = set.union(set(alignment_dict), unaligned_en)
+    return (en_g, ru_g, unaligned_en, one_to_many_en, alignment_dict, accounted_for)
+
+
+def classify_pair(i, record, prepared, en_head, en_tail, vocab, verbose=True):
+    """Finds the Russian counterpart of an English node pair. Returns
+    a (key, example) tuple, where key is a group name or an interned
+    Russian path id, or None if the pair is to be ignored. Alignment
+    problems are printed unless verbose is False."""
+    en, ru, alignment = record
+    en_g, ru_g, unaligned_en, one_to_many_en, alignment_dict, accounted_for = prepared
+    en_n = en_g
+    ru_n = ru_g
+    # Ignore one-to-many, but record unaligned and many-to-one
+    if en_head in one_to_many_en or en_tail in one_to_many_en:
+        return None
+    elif en_head in unaligned_en and en_tail in unaligned_en:
+        key = 'Both endpoints unaligned'
+        ru_head = ru_tail = ''
+    elif en_head not in accounted_for or en_tail not in accounted_for:
+        # Some asemantical stuff like pseudo-amod
+        # or possibly an error
+        if verbose:
+            print(
+                'Something is missing from the alignment dict', 
+                i+1, 
+                f'{en_head} ({en_n[en_head]["wordform"]})', 
+                f'{en_tail} ({en_n[en_tail]["wordform"]})'
+            )
+            print(extract_raw_sentences(ru))
+            print(alignment)
+            print()
+        return None
+    elif en_head in unaligned_en:
+        key = 'One endpoint unaligned'
+        ru_head = ''
+        ru_tail = alignment_dict[en_tail]
+    elif en_tail in unaligned_en:
+        key = 'One endpoint unaligned'
+        ru_tail = ''
+        ru_head = alignment_dict[en_head]
+    else:
+        try:
+            ru_head = alignment_dict[en_head]
+            ru_tail = alignment_dict[en_tail]
+        except KeyError as e:
+            if verbose:
+                print(i+1, e)
                 print(extract_raw_sentences(ru))
                 print(alignment)
                 print()
-                continue
-            elif en_head in unaligned_en:
-                key = 'One endpoint unaligned'
-                ru_head = ''
-                ru_tail = alignment_dict[en_tail]
-            elif en_tail in unaligned_en:
-                key = 'One endpoint unaligned'
-                ru_tail = ''
-                ru_head = alignment_dict[en_head]
-            else:
-                try:
-                    ru_head = alignment_dict[en_head]
-                    ru_tail = alignment_dict[en_tail]
-                except KeyError as e:
-                    print(i+1, e)
-                    print(extract_raw_sentences(ru))
-                    print(alignment)
-                    print()
-                    continue
-                if ru_head == ru_tail:
-                    key = 'Nodes collapsed'
-                else:
-                    key = '->'.join(
-                        strip_directions(
-                            get_path(
-                                ru_head, ru_tail, ru_g)))
-            
-            # Add the example
-            tmp_en = []
-            try:
-                en_keys = list(map(str, sorted([int(k) for k in en_n])))
-            except ValueError as e:
-                print(i+1, e)
-                print(record)
-                print()
-                continue
-            for k in en_keys:
-                if k in {en_head, en_tail}:
-                    tmp_en.append(f"<b>{en_n[k]['wordform']}</b>")
-                else:
-                    tmp_en.append(en_n[k]['wordform'])
-            tmp_ru = []
-            ru_keys = list(map(str, sorted([int(k) for k in ru_n])))
-            for k in ru_keys:
-                if k in {ru_head, ru_tail}:
-                    tmp_ru.append(f"<b>{ru_n[k]['wordform']}</b>")
-                else:
-                    tmp_ru.append(ru_n[k]['wordform'])
-            
-            if key not in temp_dict:
-                temp_dict[key] = []
-            temp_dict[key].append( f"{' '.join(tmp_en)} -> {' '.join(tmp_ru)}" )
+            return None
+        if ru_head == ru_tail:
+            key = 'Nodes collapsed'
+        else:
+            key = vocab.intern(ru_g.relation_path(ru_head, ru_tail))
     
-    for item in sorted(
-        temp_dict.items(),
+    # Add the example
+    tmp_en = []
+    try:
+        en_keys = list(map(str, sorted([int(k) for k in en_n])))
+    except ValueError as e:
+        if verbose:
+            print(i+1, e)
+            print(record)
+            print()
+        return None
+    for k in en_keys:
+        if k in {en_head, en_tail}:
+            tmp_en.append(f"<b>{en_n[k]['wordform']}</b>")
+        else:
+            tmp_en.append(en_n[k]['wordform'])
+    tmp_ru = []
+    ru_keys = list(map(str, sorted([int(k) for k in ru_n])))
+    for k in ru_keys:
+        if k in {ru_head, ru_tail}:
+            tmp_ru.append(f"<b>{ru_n[k]['wordform']}</b>")
+        else:
+            tmp_ru.append(ru_n[k]['wordform'])
+    return (key, f"{' '.join(tmp_en)} -> {' '.join(tmp_ru)}")
+
+
+# Inverted index of English paths. For every path it lists the
+# (rowid, head, tail) triples of the English node pairs connected by it,
+# in the order in which a full scan of the table would meet them. It is
+# stored next to the database and rebuilt when the English side changes;
+# that is checked when a process first uses the index of a table.
+
+_path_indexes = {}
+
+
+def path_index_path(corpus):
+    return f'{fname}.{corpus}.paths.npz'
+
+
+def english_side_hash(corpus):
+    digest = hashlib.sha1()
+    for rowid, en in cursor.execute(f'select rowid, `en` from `{corpus}` order by rowid'):
+        digest.update(f'{rowid}\t{en}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_path_index(corpus, corpus_hash=None):
+    """Builds and stores the path index of a table. Sentences that
+    cannot be parsed are left out and listed on stderr."""
+    if corpus_hash is None:
+        corpus_hash = english_side_hash(corpus)
+    vocab = PathVocabulary()
+    path_ids = array('i')
+    rowids = array('q')
+    heads = array('H')
+    tails = array('H')
+    skipped = []
+    for rowid, en in cursor.execute(f'select rowid, `en` from `{corpus}` order by rowid').fetchall():
+        try:
+            en_g = conll2tree(en)
+        except ValueError as e:
+            skipped.append(f'{rowid} ({e})')
+            continue
+        for head, tail in combs(range(1, len(en_g)+1), 2):
+            path_ids.append(vocab.intern(en_g.relation_path(head, tail)))
+            rowids.append(rowid)
+            heads.append(head)
+            tails.append(tail)
+    if skipped:
+        print(f'{corpus}: {len(skipped)} sentences not indexed: {", ".join(skipped)}',
+              file=stderr)
+    path_ids = np.frombuffer(path_ids, dtype=np.int32)
+    order = np.argsort(path_ids, kind='stable')
+    index = {
+        'corpus_hash': np.array(corpus_hash),
+        'paths': np.array([vocab.to_str(i) for i in range(len(vocab))]),
+        'offsets': np.searchsorted(path_ids[order], np.arange(len(vocab)+1)),
+        'rowids': np.frombuffer(rowids, dtype=np.int64)[order],
+        'heads': np.frombuffer(heads, dtype=np.uint16)[order],
+        'tails': np.frombuffer(tails, dtype=np.uint16)[order]
+    }
+    with open(path_index_path(corpus), 'wb') as out:
+        np.savez(out, **index)
+    return index
+
+
+def load_path_index(corpus):
+    """Returns the path index for a table, building it if it is missing
+    or out of date. The English side is hashed on the first call for a
+    table only; later calls in the same process reuse the index."""
+    index = _path_indexes.get(corpus)
+    if index is not None:
+        return index
+    corpus_hash = english_side_hash(corpus)
+    if os.path.exists(path_index_path(corpus)):
+        with np.load(path_index_path(corpus)) as data:
+            index = {k: data[k] for k in data.files}
+    if index is None or str(index['corpus_hash']) != corpus_hash:
+        index = build_path_index(corpus, corpus_hash)
+    if 'positions' not in index:
+        index['positions'] = {p: i for i, p in enumerate(index['paths'].tolist())}
+    _path_indexes[corpus] = index
+    return index
+
+
+def path_occurrences(corpus, path_str):
+    """Returns (rowid, en_head, en_tail) for all English node pairs
+    connected by path_str, grouped by rowid."""
+    index = load_path_index(corpus)
+    i = index['positions'].get(path_str)
+    if i is None:
+        return []
+    start, end = index['offsets'][i], index['offsets'][i+1]
+    return list(zip(
+        index['rowids'][start:end].tolist(),
+        map(str, index['heads'][start:end].tolist()),
+        map(str, index['tails'][start:end].tolist())))
+
+
+def get_edge_label_report(corpus, path_str, instr=NO_INSTRUMENTATION):
+    # From each verified record in the db take the English
+    # edges with the given path (found via the path index)
+    # and their counterparts with marked-up examples.
+    # Classify by counterparts and return in the
+    # of decreasing group sizes.
+    temp_dict = {}
+    vocab = PathVocabulary()
+    with instr.stage('index'):
+        verified = {
+            rowid: i for i, (rowid,) in enumerate(cursor.execute(
+                f'select rowid from `{corpus}` where verified = 1 order by rowid'))
+        }
+        occurrences = path_occurrences(corpus, path_str)
+    current_rowid = None
+    for rowid, en_head, en_tail in occurrences:
+        if rowid not in verified:
+            continue
+        if rowid != current_rowid:
+            current_rowid = rowid
+            with instr.stage('read'):
+                record = cursor.execute(
+                    f'select `en`,`ru`,`alignment` from `{corpus}` where rowid = ?',
+                    (rowid,)).fetchone()
+            with instr.stage('parse'):
+                prepared = prepare_record(*record)
+            instr.count('sentences')
+        with instr.stage('classify'):
+            classified = classify_pair(
+                verified[rowid], record, prepared, en_head, en_tail, vocab)
+        instr.count('pairs')
+        if classified is None:
+            continue
+        key, example = classified
+        if key not in temp_dict:
+            temp_dict[key] = []
+        temp_dict[key].append(example)
+    
+    with instr.stage('aggregation'):
+        return group_report(temp_dict, vocab)
+
+def group_report(groups, vocab):
+    """Sorts counterpart groups by decreasing size and converts
+    interned target paths to strings."""
+    result = []
+    for key, examples in sorted(
+        groups.items(),
         key = lambda x: len(x[1]),
         reverse = True
     ):
-        result.append(item)
-    
+        if isinstance(key, int):
+            key = vocab.to_str(key)
+        result.append((key, examples))
     return result
 
+
+def path_completions(corpus, verified_rowids):
+    """Maps rowids to the English paths whose last verified occurrence
+    is in that row, according to the path index."""
+    index = load_path_index(corpus)
+    rowids = index['rowids']
+    offsets = index['offsets']
+    last = np.where(np.isin(rowids, verified_rowids), rowids, -1)
+    nonempty = offsets[:-1] < offsets[1:]
+    last_rowids = np.full(len(index['paths']), -1, dtype=np.int64)
+    last_rowids[nonempty] = np.maximum.reduceat(last, offsets[:-1][nonempty])
+    completions = {}
+    for path_str, rowid in zip(index['paths'].tolist(), last_rowids.tolist()):
+        if rowid >= 0:
+            completions.setdefault(rowid, []).append(path_str)
+    return completions
+
+
+def iter_all_edge_label_reports(corpus, instr=NO_INSTRUMENTATION):
+    """Computes the reports of get_edge_label_report for all English
+    paths at once in a single pass over the verified records, yielding
+    (path, report) as soon as the last verified sentence with the path
+    has been classified, so that only the reports of unfinished paths
+    are held in memory. Alignment problems are skipped silently."""
+    vocab = PathVocabulary()
+    buckets = {}
+    with instr.stage('index'):
+        verified_rowids = [rowid for (rowid,) in cursor.execute(
+            f'select rowid from `{corpus}` where verified = 1 order by rowid')]
+        completions = path_completions(corpus, verified_rowids)
+    records = conn.execute(
+        f'select rowid, `document_id`,`sentence_id`,`en`,`ru`,`alignment` from `{corpus}` where verified = 1 order by rowid')
+    i = 0
+    while True:
+        with instr.stage('read'):
+            row = records.fetchone()
+        if row is None:
+            break
+        rowid, document_id, sentence_id, *record = row
+        with instr.item('sentence', f'{document_id}/{sentence_id}'):
+            with instr.stage('parse'):
+                prepared = prepare_record(*record)
+            en_g = prepared[0]
+            with instr.stage('classify'):
+                for en_head, en_tail in combs(en_g, 2):
+                    classified = classify_pair(
+                        i, record, prepared, en_head, en_tail, vocab, verbose=False)
+                    if classified is None:
+                        continue
+                    key, example = classified
+                    path_en = vocab.intern(en_g.relation_path(en_head, en_tail))
+                    groups = buckets.setdefault(path_en, {})
+                    if key not in groups:
+                        groups[key] = []
+                    groups[key].append(example)
+        instr.count('sentences')
+        instr.count('pairs', len(en_g) * (len(en_g) - 1) // 2)
+        i += 1
+        for path_str in completions.pop(rowid, []):
+            groups = buckets.pop(vocab.intern_str(path_str), None)
+            if groups is not None:
+                with instr.stage('aggregation'):
+                    report = group_report(groups, vocab)
+                yield path_str, report
+    # Paths the index does not know about, e.g. if it is out of step
+    for path_en, groups in buckets.items():
+        yield vocab.to_str(path_en), group_report(groups, vocab)
+
+
+def get_all_edge_label_reports(corpus, instr=NO_INSTRUMENTATION):
+    """Returns a dict mapping English paths to their reports, see
+    iter_all_edge_label_reports."""
+    return dict(iter_all_edge_label_reports(corpus, instr))
+
+
+def write_all_edge_label_reports(corpus, out, instr=NO_INSTRUMENTATION):
+    """Writes the reports for all English paths as a JSON object keyed by
+    path. Each path is written as soon as its report is complete, so
+    paths come in the order of their last verified occurrence."""
+    out.write('{')
+    for n, (path_en, report) in enumerate(iter_all_edge_label_reports(corpus, instr)):
+        with instr.stage('write'):
+            if n:
+                out.write(',')
+            out.write(f'\n{json.dumps(path_en)}: ')
+            json.dump(report, out, ensure_ascii=False)
+    out.write('\n}\n')
+
+
 if __name__ == "__main__":
-    pprint(get_edge_label_report(argv[1], argv[2]))
\ No newline at end of file
+    # report_path_mappings.py <table> <path> prints a single report;
+    # report_path_mappings.py <table> --all [output.json] writes all of them.
+    parser = ArgumentParser()
+    parser.add_argument('table')
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('--all', nargs='?', const='-', metavar='OUT',
+                        help='write the reports for all paths as JSON')
+    parser.add_argument('--stats', metavar='FILE',
+                        help="write per-stage timings and counters as JSON ('-' for stderr)")
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write cProfile statistics of the run')
+    args = parser.parse_args()
+    if args.all is None and args.path is None:
+        parser.error('a path or --all is required')
+    instr = Instrumentation() if args.stats else NO_INSTRUMENTATION
+    with profiled(args.profile):
+        if args.all == '-':
+            write_all_edge_label_reports(args.table, stdout, instr)
+        elif args.all is not None:
+            with open(args.all, 'w', encoding='utf-8') as out:
+                write_all_edge_label_reports(args.table, out, instr)
+        else:
+            pprint(get_edge_label_report(args.table, args.path, instr))
+    if args.stats:
+        instr.write_summary(args.stats)
@@ -0,0 +1,167 @@
+# Token-level tables derived from the CoNLL-U blobs and alignments of
+# the corpora, so that syntactic questions can be answered in SQL:
+#
+#   sentence_keys(sentence_key, document_id, sentence_id) -- integer
+#          keys of sentences, which keep the tables below small
+#   tokens(language, sentence_key, token_id, form, lemma, upos, head,
+#          deprel) -- one row per word; English is stored once as
+#          language 'en', the target side of en-xx as 'xx'
+#   alignment_edges(corpus, sentence_key, en_token, target_token) --
+#          1-based token ids, NULL for unaligned words
+#
+# E.g. all obl dependents of verbs on the Russian side:
+#
+#   SELECT t.* FROM tokens AS t JOIN tokens AS h
+#     ON h.language = t.language AND h.sentence_key = t.sentence_key
+#     AND h.token_id = t.head
+#   WHERE t.language = 'ru' AND t.deprel = 'obl' AND h.upos = 'VERB'
+#
+# or the relations that aligned words have in English and Russian:
+#
+#   SELECT en.deprel, ru.deprel, count(*) FROM alignment_edges AS a
+#     JOIN tokens AS en ON en.language = 'en'
+#       AND en.sentence_key = a.sentence_key AND en.token_id = a.en_token
+#     JOIN tokens AS ru ON ru.language = 'ru'
+#       AND ru.sentence_key = a.sentence_key AND ru.token_id = a.target_token
+#   WHERE a.corpus = 'en-ru' GROUP BY 1, 2
+#
+# Once the tables exist, populate_db.py rebuilds them for every table it
+# loads and ud-app.py replaces the alignment edges of every sentence
+# whose alignment it changes.
+# Usage: token_tables.py [db] [table ...]
+
+from sqlalchemy import create_engine, text
+from sys import argv, exit
+
+CREATE_SQL = [
+    """CREATE TABLE IF NOT EXISTS `sentence_keys` ( `sentence_key` INTEGER PRIMARY KEY, `document_id` TEXT NOT NULL, `sentence_id` TEXT NOT NULL, UNIQUE (`document_id`, `sentence_id`) )""",
+    """CREATE TABLE IF NOT EXISTS `tokens` ( `language` TEXT NOT NULL, `sentence_key` INTEGER NOT NULL, `token_id` INTEGER NOT NULL, `form` TEXT NOT NULL, `lemma` TEXT NOT NULL, `upos` TEXT NOT NULL, `head` INTEGER, `deprel` TEXT NOT NULL, PRIMARY KEY (`language`, `sentence_key`, `token_id`) ) WITHOUT ROWID""",
+    """CREATE INDEX IF NOT EXISTS `tokens_deprel_idx` ON `tokens` (`language`, `deprel`)""",
+    """CREATE INDEX IF NOT EXISTS `tokens_upos_idx` ON `tokens` (`language`, `upos`)""",
+    """CREATE INDEX IF NOT EXISTS `tokens_lemma_idx` ON `tokens` (`language`, `lemma`)""",
+    """CREATE TABLE IF NOT EXISTS `alignment_edges` ( `corpus` TEXT NOT NULL, `sentence_key` INTEGER NOT NULL, `en_token` INTEGER, `target_token` INTEGER )""",
+    """CREATE INDEX IF NOT EXISTS `alignment_edges_sentence_idx` ON `alignment_edges` (`corpus`, `sentence_key`, `en_token`)"""
+]
+
+INSERT_TOKEN_SQL = """INSERT OR REPLACE INTO `tokens` (`language`, `sentence_key`, `token_id`, `form`, `lemma`, `upos`, `head`, `deprel`) VALUES (:language, :sentence_key, :token_id, :form, :lemma, :upos, :head, :deprel)"""
+
+INSERT_EDGE_SQL = """INSERT INTO `alignment_edges` (`corpus`, `sentence_key`, `en_token`, `target_token`) VALUES (:corpus, :sentence_key, :en_token, :target_token)"""
+
+
+def target_language(corpus):
+    """'ru' for en-ru; other table names are used as they are."""
+    return corpus[3:] if corpus.startswith('en-') else corpus
+
+
+def conllu_tokens(conllu):
+    """Yields (token_id, form, lemma, upos, head, deprel) for the words
+    of a sentence, skipping multiword tokens and empty nodes."""
+    for line in conllu.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if '-' in fields[0] or '.' in fields[0]:
+            continue
+        head = int(fields[6]) if fields[6].isdigit() else None
+        yield (int(fields[0]), fields[1], fields[2], fields[3], head, fields[7])
+
+
+def parse_alignment(alignment):
+    """Returns the (en_token, target_token) pairs of a pharao alignment
+    string with 0-based indices and X for unaligned words as 1-based
+    token ids with None for X. Raises ValueError for malformed edges."""
+    edges = []
+    for edge in alignment.split():
+        ends = edge.split('-')
+        if len(ends) != 2:
+            raise ValueError(f'Malformed alignment edge: {edge}')
+        en, target = (None if end == 'X' else int(end) + 1 for end in ends)
+        if en is None and target is None:
+            raise ValueError(f'Malformed alignment edge: {edge}')
+        edges.append((en, target))
+    return edges
+
+
+def enabled(conn):
+    return conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'alignment_edges'")).fetchone() is not None
+
+
+def corpora(conn):
+    """Tables and views with alignments, except for the storage tables
+    of normalized corpora."""
+    return [row[0] for row in conn.execute(text(
+        "SELECT name FROM sqlite_master AS m WHERE type IN ('table', 'view') AND name NOT LIKE '%\\_target' ESCAPE '\\' AND EXISTS (SELECT 1 FROM pragma_table_info(m.name) WHERE name = 'alignment')"))]
+
+
+def sentence_key(conn, document_id, sentence_id):
+    """Returns the key of a sentence, assigning a new one if needed."""
+    ids = {'document_id': document_id, 'sentence_id': sentence_id}
+    conn.execute(text('INSERT OR IGNORE INTO `sentence_keys` (`document_id`, `sentence_id`) VALUES (:document_id, :sentence_id)'), **ids)
+    return conn.execute(text('SELECT `sentence_key` FROM `sentence_keys` WHERE `document_id` = :document_id AND `sentence_id` = :sentence_id'), **ids).scalar()
+
+
+def sentence_tokens(language, key, conllu):
+    return [
+        {'language': language, 'sentence_key': key, 'token_id': token_id,
+         'form': form, 'lemma': lemma, 'upos': upos, 'head': head, 'deprel': deprel}
+        for token_id, form, lemma, upos, head, deprel in conllu_tokens(conllu)]
+
+
+def sentence_edges(corpus, key, edges):
+    return [
+        {'corpus': corpus, 'sentence_key': key,
+         'en_token': en_token, 'target_token': target_token}
+        for en_token, target_token in edges]
+
+
+def build(conn, corpus):
+    """(Re)creates the tokens of both sides of a corpus and its alignment
+    edges. Must be called inside a transaction. Sentences with malformed
+    alignments get no edges. Returns the number of sentences."""
+    for stmt in CREATE_SQL:
+        conn.execute(stmt)
+    language = target_language(corpus)
+    conn.execute(text('DELETE FROM `tokens` WHERE `language` = :language'), language=language)
+    conn.execute(text('DELETE FROM `alignment_edges` WHERE `corpus` = :corpus'), corpus=corpus)
+    conn.execute(f'INSERT OR IGNORE INTO `sentence_keys` (`document_id`, `sentence_id`) SELECT `document_id`, `sentence_id` FROM `{corpus}` ORDER BY rowid')
+    insert_token = text(INSERT_TOKEN_SQL)
+    insert_edge = text(INSERT_EDGE_SQL)
+    n = 0
+    for key, en, target, alignment in conn.execute(
+            f'SELECT k.`sentence_key`, c.`en`, c.`ru`, c.`alignment` FROM `{corpus}` AS c JOIN `sentence_keys` AS k ON k.`document_id` = c.`document_id` AND k.`sentence_id` = c.`sentence_id`').fetchall():
+        conn.execute(insert_token,
+                     sentence_tokens('en', key, en)
+                     + sentence_tokens(language, key, target))
+        try:
+            edges = parse_alignment(alignment)
+        except ValueError:
+            edges = []
+        if edges:
+            conn.execute(insert_edge, sentence_edges(corpus, key, edges))
+        n += 1
+    return n
+
+
+def replace_alignment(conn, corpus, document_id, sentence_id, edges):
+    """Replaces the alignment edges of a sentence with `edges` from
+    parse_alignment. Must be called in the transaction that changes the
+    alignment."""
+    key = sentence_key(conn, document_id, sentence_id)
+    conn.execute(
+        text('DELETE FROM `alignment_edges` WHERE `corpus` = :corpus AND `sentence_key` = :sentence_key'),
+        corpus=corpus, sentence_key=key)
+    if edges:
+        conn.execute(text(INSERT_EDGE_SQL), sentence_edges(corpus, key, edges))
+
+
+if __name__ == '__main__':
+    fname = argv[1] if len(argv) > 1 else 'pud.db'
+    db_connect = create_engine(f'sqlite:///{fname}')
+    with db_connect.connect() as conn:
+        tables = argv[2:] or corpora(conn)
+        if not tables:
+            exit(f'No corpora in {fname}')
+        with conn.begin():
+            for corpus in tables:
+                n = build(conn, corpus)
+                print(f'{corpus}: tokens and alignment edges of {n} sentences stored')
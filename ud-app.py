@@ -1,17 +1,193 @@
-from flask import Flask, request
+import gzip
+import json
+import hashlib
+
+from flask import Flask, Response, request
 from flask_restful import Resource, Api, reqparse, abort
 from flask_restful.utils import cors
-from sqlalchemy import (create_engine, MetaData, Table, select, update, and_)
+from sqlalchemy import (create_engine, event, func, text, MetaData, Table, select, update, and_)
+from sqlalchemy.exc import NoSuchTableError, IntegrityError
+from sqlalchemy.pool import QueuePool
+from threading import Lock
+
+import path_stats
+import token_tables
 
 app = Flask(__name__)
 api = Api(app)
 api.decorators=[cors.crossdomain(origin='*')]
 
-db_connect = create_engine('sqlite:///pud.db')
+# One pooled connection per concurrent request; SQLite itself waits
+# up to BUSY_TIMEOUT_MS for a lock before giving up.
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 30000
+
+# Sentences per /range response
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+db_connect = create_engine(
+    'sqlite:///pud.db',
+    poolclass = QueuePool,
+    pool_size = POOL_SIZE,
+    max_overflow = POOL_SIZE,
+    connect_args = {
+        'timeout': BUSY_TIMEOUT_MS / 1000,
+        'check_same_thread': False
+        }
+    )
+
+
+@event.listens_for(db_connect, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers proceed while an annotator's update is being
+    written."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    cursor.close()
+
 
 meta = MetaData()
 meta.reflect(bind=db_connect)
-        
+meta_lock = Lock()
+# Tables whose reflection is complete. Table(..., autoload = True) puts a
+# table in meta.tables before its columns are read, so other threads
+# must not pick tables up from there.
+tables = dict(meta.tables)
+write_tables = {}
+
+
+def get_table(table_name):
+    """Returns the reflected table, reflecting it only the first time it
+    is requested. Unknown tables result in a 404."""
+    pud_table = tables.get(table_name)
+    if pud_table is not None:
+        return pud_table
+    with meta_lock:
+        pud_table = tables.get(table_name)
+        if pud_table is not None:
+            return pud_table
+        try:
+            pud_table = Table(table_name, meta, autoload = True, autoload_with = db_connect)
+        except NoSuchTableError:
+            abort(404, message = f"No such corpus: {table_name}")
+        tables[table_name] = pud_table
+        return pud_table
+
+
+def get_write_table(table_name):
+    """Returns the table alignment updates go to. For a normalized corpus
+    (a view over sentences_en, see populate_db.py) that is its `_target`
+    table, which, unlike the view, reports the number of matched rows."""
+    write_table = write_tables.get(table_name)
+    if write_table is not None:
+        return write_table
+    pud_table = get_table(table_name)
+    with meta_lock:
+        write_table = write_tables.get(table_name)
+        if write_table is not None:
+            return write_table
+        storage_name = f'{table_name}_target'
+        write_table = tables.get(storage_name)
+        if write_table is None:
+            try:
+                write_table = Table(storage_name, meta, autoload = True, autoload_with = db_connect)
+                tables[storage_name] = write_table
+            except NoSuchTableError:
+                write_table = pud_table
+        write_tables[table_name] = write_table
+    return write_table
+
+
+def sentence_columns(pud_table):
+    """The columns of a corpus that are sent to clients. Normalized
+    corpora expose rowid as a view column for ordering; it is left out
+    so that responses look the same for both layouts."""
+    return [column for column in pud_table.c if column.name != 'rowid']
+
+
+def ensure_id_indexes():
+    """Makes (document_id, sentence_id) lookups in corpus tables index
+    searches. The index is unique unless the table already has
+    duplicate ids."""
+    with db_connect.connect() as conn:
+        for table_name, pud_table in meta.tables.items():
+            if not {'document_id', 'sentence_id', 'alignment'} <= set(pud_table.c.keys()):
+                continue
+            index_name = f'{table_name}_document_sentence_idx'
+            try:
+                conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS `{index_name}` ON `{table_name}` (`document_id`, `sentence_id`)')
+            except IntegrityError:
+                print(f'Duplicate sentence ids in {table_name}, using a non-unique index')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS `{index_name}` ON `{table_name}` (`document_id`, `sentence_id`)')
+
+
+ensure_id_indexes()
+
+
+def update_values(args):
+    """Validates the alignment and verification status sent by a client
+    and returns the column values to update. Raises ValueError with a
+    message for the client if the data are invalid."""
+    if not isinstance(args, dict):
+        raise ValueError("An object with alignment and/or verified is expected")
+    alignment = args.get('alignment')
+    verified = args.get('verified')
+    if alignment is None and verified is None:
+        raise ValueError("No data provided")
+    vals = {}
+    if not (alignment is None): # Can be an empty string
+        if not isinstance(alignment, str):
+            raise ValueError(f"Alignment must be a string, is {alignment!r}")
+        vals['alignment'] = alignment
+    if not (verified is None): # Can be zero
+        try:
+            vals['verified'] = int(verified)
+        except (TypeError, ValueError):
+            raise ValueError(f"Verification value is invalid: {verified}")
+        if vals['verified'] not in {0,1}:
+            raise ValueError(f"Verification value is must be 0 or 1, is {verified}")
+    return vals
+
+
+def apply_update(conn, table_name, document_id, sentence_id, vals):
+    """Updates one sentence inside the caller's transaction. Path
+    statistics (see path_stats.py) and alignment edges (see
+    token_tables.py), where kept, are updated in the same transaction.
+    Returns False if there is no such sentence; raises ValueError if an
+    alignment cannot be processed."""
+    pud_table = get_write_table(table_name)
+    edges = None
+    if 'alignment' in vals and token_tables.enabled(conn):
+        edges = token_tables.parse_alignment(vals['alignment'])
+    if path_stats.enabled(conn, table_name):
+        row = conn.execute(
+            f'SELECT rowid, `en`, `ru`, `alignment`, `verified` FROM `{table_name}` WHERE `document_id` = ? AND `sentence_id` = ?',
+            (document_id, sentence_id)).fetchone()
+        if row is None:
+            return False
+        position, en, target, alignment, verified = row
+        alignment = vals.get('alignment', alignment)
+        pairs = {}
+        if vals.get('verified', verified) == 1:
+            pairs = path_stats.sentence_path_pairs(en, target, alignment)
+        path_stats.replace_sentence(conn, table_name, document_id, sentence_id, position, pairs)
+    stmt = pud_table.update().\
+        where(
+            and_(
+                pud_table.c.document_id == document_id,
+                pud_table.c.sentence_id == sentence_id
+                )
+            ).\
+        values(**vals)
+    if conn.execute(stmt).rowcount == 0:
+        return False
+    if edges is not None:
+        token_tables.replace_alignment(conn, table_name, document_id, sentence_id, edges)
+    return True
+
 
 class AlignmentServerByID(Resource):
     """Returns aligned sentences with alignment and verification
@@ -19,8 +195,8 @@ class AlignmentServerByID(Resource):
     with POST."""
     def get(self, table_name, document_id, sentence_id):
         with db_connect.connect() as conn:
-            pud_table = Table(table_name, meta, autoload = True)
-            stmt = select([pud_table]).\
+            pud_table = get_table(table_name)
+            stmt = select(sentence_columns(pud_table)).\
                 where(
                     and_(
                         pud_table.c.document_id == document_id,
@@ -32,58 +208,162 @@ class AlignmentServerByID(Resource):
 
         
     def post(self, table_name, document_id, sentence_id):
-        args = {
-            'alignment': None,
-            'verified': None
-            }
-        args.update(request.get_json(force = True))
-        if args['alignment'] is None and args['verified'] is None:
-            abort(400, message = "No data provided")
-        vals = {}
-        if not (args['alignment'] is None): # Can be an empty string
-            vals['alignment'] = args['alignment']
-        if not (args['verified'] is None): # Can be zero
-            try:
-                vals['verified'] = int(args['verified'])
-                if vals['verified'] not in {0,1}:
-                    abort(400, message = f"Verification value is must be 0 or 1, is {args['verified']}")
-            except ValueError:
-                abort(400, message = f"Verification value is invalid: {args['verified']}")
+        try:
+            vals = update_values(request.get_json(force = True))
+        except ValueError as e:
+            abort(400, message = str(e))
         with db_connect.connect() as conn:
-            pud_table = Table(table_name, meta, autoload = True)
-            stmt = pud_table.update().\
-                where(
-                    and_(
-                        pud_table.c.document_id == document_id,
-                        pud_table.c.sentence_id == sentence_id
-                        )
-                    ).\
-                values(**vals)
-            rs = conn.execute(stmt)
+            try:
+                with conn.begin():
+                    apply_update(conn, table_name, document_id, sentence_id, vals)
+            except ValueError as e:
+                abort(400, message = str(e))
             return [] # The status defaults to 200
 
         
+class AlignmentServerBulkUpdate(Resource):
+    """Applies many alignment/verification updates with POST in a single
+    transaction. The body is a list of objects with document_id,
+    sentence_id and alignment and/or verified. Invalid records and
+    records that match no sentence are reported by their position in
+    the list and skipped; with ?atomic=1 any such error rolls back the
+    whole batch."""
+    def post(self, table_name):
+        records = request.get_json(force = True)
+        if not isinstance(records, list):
+            abort(400, message = "A list of records is expected")
+        atomic = request.args.get('atomic', 0, type = int) == 1
+        get_write_table(table_name) # 404 for unknown corpora
+        errors = []
+        updates = []
+        for i, record in enumerate(records):
+            try:
+                vals = update_values(record)
+                key = (record['document_id'], record['sentence_id'])
+            except KeyError as e:
+                errors.append({'index': i, 'message': f"Missing {e.args[0]}"})
+                continue
+            except ValueError as e:
+                errors.append({'index': i, 'message': str(e)})
+                continue
+            updates.append((i, key, vals))
+        if atomic and errors:
+            return {'updated': 0, 'errors': errors}, 400
+        updated = 0
+        with db_connect.connect() as conn:
+            trans = conn.begin()
+            try:
+                for i, (document_id, sentence_id), vals in updates:
+                    try:
+                        found = apply_update(conn, table_name, document_id, sentence_id, vals)
+                    except ValueError as e:
+                        errors.append({'index': i, 'message': str(e)})
+                        continue
+                    if not found:
+                        errors.append({'index': i, 'message': f"No sentence {document_id}/{sentence_id}"})
+                    else:
+                        updated += 1
+            except Exception:
+                trans.rollback()
+                raise
+            if atomic and errors:
+                trans.rollback()
+                return {'updated': 0, 'errors': errors}, 400
+            trans.commit()
+        errors.sort(key = lambda x: x['index'])
+        return {'updated': updated, 'errors': errors}
+
+
+class AlignmentServerPathStats(Resource):
+    """Returns the path entropy table of create_arrays.py (path, count,
+    entropy, prob1..k, path1..k) for a corpus with materialized path
+    statistics, reflecting all updates saved so far."""
+    def get(self, table_name):
+        k = request.args.get('k', 3, type = int)
+        if not 0 < k <= 10:
+            abort(400, message = f"Invalid k: {k}; k must be between 1 and 10")
+        with db_connect.connect() as conn:
+            if not path_stats.enabled(conn, table_name):
+                abort(404, message = f"No path statistics for {table_name}")
+            table = path_stats.entropy_table(conn, table_name, k)
+        columns = list(table)
+        return json_response([dict(zip(columns, row)) for row in zip(*table.values())])
+
+
 class AlignmentServerGetCorpora(Resource):
     def get(self):
         with db_connect.connect() as conn:
-            rs = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            return [dict(row) for row in rs.fetchall()]
+            return [{'name': name} for name in token_tables.corpora(conn)]
 
 
 class AlignmentServerGetIDs(Resource):
     def get(self, table_name):
         with db_connect.connect() as conn:
-            pud_table = Table(table_name, meta, autoload = True)
+            pud_table = get_table(table_name)
+            # Insertion order; the (document_id, sentence_id) index
+            # would otherwise return the ids sorted
             stmt = select([
                 pud_table.c.document_id,
                 pud_table.c.sentence_id         
-            ])
+            ]).order_by(text('rowid'))
             rs = conn.execute(stmt)
             return [dict(row) for row in rs.fetchall()]
 
 
+class AlignmentServerRange(Resource):
+    """Returns `count` consecutive sentences (both sides, the alignment
+    and the verification status) starting from the 0-based position
+    `start` in the order of getids. Responses carry an ETag, honour
+    If-None-Match and are gzipped for clients that accept it."""
+    def get(self, table_name):
+        start = request.args.get('start', 0, type = int)
+        count = request.args.get('count', PAGE_SIZE, type = int)
+        if start < 0 or not 0 < count <= MAX_PAGE_SIZE:
+            abort(400, message = f"Invalid range: start={start}, count={count}; count must be between 1 and {MAX_PAGE_SIZE}")
+        pud_table = get_table(table_name)
+        with db_connect.connect() as conn:
+            total = conn.execute(
+                select([func.count()]).select_from(pud_table)).scalar()
+            stmt = select(sentence_columns(pud_table)).\
+                order_by(text('rowid')).\
+                offset(start).\
+                limit(count)
+            rs = conn.execute(stmt)
+            sentences = [dict(row) for row in rs.fetchall()]
+        return json_response({
+            'start': start,
+            'total': total,
+            'sentences': sentences
+            })
+
+
+def json_response(data):
+    """Serialises data as JSON with an ETag derived from the content,
+    answering 304 to a matching If-None-Match and gzipping the body
+    when the client accepts it."""
+    body = json.dumps(data, ensure_ascii = False).encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if gzipped:
+        etag += '-gzip'
+    response = Response(mimetype = 'application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+    if gzipped:
+        body = gzip.compress(body, compresslevel = 6)
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_data(body)
+    return response
+
+
 api.add_resource(AlignmentServerGetCorpora, '/corpora')
 api.add_resource(AlignmentServerGetIDs, '/getids/<table_name>')
+api.add_resource(AlignmentServerRange, '/range/<table_name>')
+api.add_resource(AlignmentServerBulkUpdate, '/bulk/<table_name>')
+api.add_resource(AlignmentServerPathStats, '/paths/<table_name>')
 api.add_resource(AlignmentServerByID, '/<table_name>/<document_id>/<sentence_id>')
 
 